@@ -32,7 +32,11 @@ from . import parser
 from . import log
 from . import resources
 from . import hashes
+from . import parallel
+from . import cache
+from . import diagnostics
 config = None
+_GROUPS_LOADED = set() # groups loaded by load_group()
 
 
 def load_parser():
@@ -72,14 +76,32 @@ def load_config(queue_files=True):
 def load_data_file(filename, group=None):
     """load_data_file(filename, group=None)
     Loads a single ini file, with the specified parser rule group.
+    If the cache is enabled the file is taken from the cache when unchanged.
+    Any numeric checks batched while parsing are done before returning.
     """
+    if cache.is_enabled():
+        if data.is_loaded(join('DATA', filename)):
+            return None
+        result = cache.lookup(group, filename)
+        if result is None:
+            result = parallel.parse_file(group, filename)
+            cache.store(group, filename, result)
+        parallel.merge_file(result)
+        return result[0]
+    flags = ini.FLAG_FLDATA + ini.FLAG_LOG + ini.FLAG_STAT
+    if settings.general.get('lazy_parsing', dtype=bool):
+        flags += ini.FLAG_LAZY
+    if settings.general.get('mmap_files', dtype=bool):
+        flags += ini.FLAG_MMAP
     try:
         return ini.IniFile(join('DATA', filename),
                            directory=settings.general['path'],
                            group=group,
-                           flags=ini.FLAG_FLDATA + ini.FLAG_LOG + ini.FLAG_STAT)
+                           flags=flags)
     except ini.FileReadError:
         return None
+    finally:
+        parser.flush_checks()
 
 def load_data_group(group):
     """load_data_group(group)
@@ -101,17 +123,83 @@ def load_data_group(group):
         pass
 
 
-def load_queue():
-    """loadQueue()
+def _template_parents(group):
+    """_template_parents(group)
+    Internal function. Returns the rule groups with ini arguments that queue
+    files for the group.
+    """
+    return [parent for parent in sorted(parser._RULES)
+            if group in parser.get_group_dependencies(parent)[0]]
+
+
+def load_group(group):
+    """load_group(group)
+    Loads a data group and the groups it depends on. The group's files are
+    taken from the queue (freelancer.ini [data] section files are queued by
+    load_config()) along with its NONREFERENCED_FILES. Groups whose ini files
+    queue files for this group are loaded first (ie: universe for systems),
+    and the groups its -m options match against are loaded after. Files queued
+    for other groups are left in the queue. Each group is only loaded once.
+    """
+    group = group.lower()
+    if group in _GROUPS_LOADED or group == 'fonts_dir':
+        return
+    _GROUPS_LOADED.add(group)
+    # dont load again from get_group() while loading
+    loader, data._GROUP_LOADER = data._GROUP_LOADER, None
+    try:
+        for parent in _template_parents(group):
+            load_group(parent)
+        for filename in settings.NONREFERENCED_FILES.get(group, ()):
+            data.queue_file(group, filename)
+        files = data.file_queue.take(group)
+        while files:
+            for _, filename in files:
+                load_data_file(filename, group)
+            # files can queue more files in the same group
+            files = data.file_queue.take(group)
+        for match in sorted(parser.get_group_dependencies(group)[1]):
+            load_group(match)
+    finally:
+        data._GROUP_LOADER = loader
+
+
+def enable_on_demand(enabled=True):
+    """enable_on_demand(enabled=True)
+    Enables or disables on demand loading. When enabled, data.get_group(),
+    get_sections() and get_key() call load_group() on first access instead
+    of needing load_queue(). Called by init() when the [General] load_on_demand
+    setting is true.
+    """
+    data._GROUP_LOADER = enabled and load_group or None
+
+
+def load_queue(processes=None, priority=None):
+    """load_queue(processes=None, priority=None)
     Loads any files in the queue, not normally called externally.
+    If processes is greater then 1 (default: the [General] load_processes
+    setting) files are parsed in a pool of worker processes. If priority is
+    given (see freelancer.core.data.GROUP_PRIORITY) only files with that
+    priority or a lower number are loaded, the rest are left in the queue.
     """
-    files = data.file_queue
-    while len(files) > 0:
-        key, val = files.pop(0)
-        if key == 'fonts_dir':
-            # skip this, its in freelancer.ini, but points to a directory not file.
-            continue
-        load_data_file(val, key)
+    # pick up files added or removed since the last load
+    parser.refresh_file_index()
+    if processes is None:
+        processes = settings.general.get('load_processes', 1, dtype=int)
+    if processes > 1:
+        parallel.load_queue(processes, priority)
+    else:
+        files = data.file_queue
+        while len(files) > 0:
+            if priority is not None and files.priority() > priority:
+                break
+            key, val = files.pop()
+            if key == 'fonts_dir':
+                # skip this, its in freelancer.ini, but points to a directory not file.
+                continue
+            load_data_file(val, key)
+    if cache.is_enabled():
+        cache.save()
 
 
 def load_nonreferenced():
@@ -127,55 +215,215 @@ def load_nonreferenced():
 
 
 
-def validate_match_queue():
-    """performMatchQueue()
+def _match_key(item):
+    """_match_key(item)
+    Internal function. Returns the (groups, sections) a match queue item is
+    checked against. Invalid -m options are a bug in the parser rules.
+    """
+    obj, _, match, _, _ = item
+    try:
+        groups, sections = parser.parse_match(match)
+    except ValueError:
+        print item
+        exit()
+    if groups is None:
+        groups = (obj.file.group,)
+    return groups, sections
+
+
+def _build_nicknames(queue):
+    """_build_nicknames(queue)
+    Internal function. Returns a dict of the nickname sets for all the (groups,
+    sections) used by the match queue, or the KeyError if a group isnt loaded.
+    """
+    nicknames = {}
+    for item in queue:
+        key = _match_key(item)
+        if item[3] or key in nicknames: # local matches dont use the nicknames
+            continue
+        try:
+            nicknames[key] = data.get_nicknames(*key)
+        except KeyError as msg:
+            nicknames[key] = msg
+    return nicknames
+
+
+def check_matches(queue, start, end, nicknames):
+    """check_matches(queue, start, end, nicknames)
+    Checks the match queue items from start to end, against the nickname sets
+    from _build_nicknames(). Returns a list of (queue index, KeyError or None)
+    tuples for the items that dont match, in queue order.
+    """
+    failed = []
+    for queue_index in xrange(start, end):
+        item = queue[queue_index]
+        obj, _, _, local, value = item
+        if local: # ignore groups
+            sections = _match_key(item)[1]
+            result = obj.file.keymap.get(value)
+            if not (result and result.section in sections):
+                failed.append((queue_index, None))
+            continue
+        names = nicknames[_match_key(item)]
+        if isinstance(names, KeyError):
+            failed.append((queue_index, names))
+        elif value not in names:
+            failed.append((queue_index, None))
+    return failed
+
+
+def _report_matches(queue, failed):
+    """_report_matches(queue, failed)
+    Internal function. Reports the failed match queue items from check_matches()
+    """
+    for queue_index, error in failed:
+        obj, index, match, _, value = queue[queue_index]
+        if error is not None:
+            log.error('keyerror: %s (%s)' % (error, match))
+        diagnostics.report(diagnostics.NO_MATCH, obj.file.path, obj.index + index,
+                           value, match)
+
+
+def validate_match_queue(processes=None):
+    """validate_match_queue(processes=None)
     Does all queued cross reference validation checks (-m|--match rule arguments),
     comparing ini sections that link to other sections. Note unless everything
-    (all files) were loaded, this wont work. Logs the errors.
+    (all files) were loaded, this wont work. Logs the errors. With lazy_parsing
+    the sections that havent been used yet are parsed first, so their cross
+    references are checked too.
+    If processes is greater then 1 (default: the [General] match_processes
+    setting) the checks are split between a pool of worker processes. The
+    errors are reported in the same order either way.
     """
-    import re
     import time
+    if processes is None:
+        processes = settings.general.get('match_processes', 1, dtype=int)
+    parsed = sum([obj.parse_lazy() for obj in data._LOADED.values()])
+    if parsed:
+        log.info("Cross Reference: parsed %s unused lazy sections" % parsed)
+    parser.flush_checks() # lazy sections, and files read outside load_data_file()
     log.log("Cross Reference Errors")
+    queue = data.match_queue
     start_time = time.time()
-    _mre = re.compile('([^\:]+)?\:([^\:]+)?')
-    count = 0
-    for queue_index, queue_item in enumerate(data.match_queue):
-        result = None
-        obj, index, match, local, value = queue_item
-        try:
-            groups, sections = _mre.match(match.lower()).groups()
-        except AttributeError:
-            print queue_item
-            exit()
-        if not groups:
-            groups = obj.file.group
-        groups = groups.split('|')
-        if sections:
-            sections = sections.split('|')
-        else:
-            sections = (None,)
+    nicknames = _build_nicknames(queue)
+    index_time = time.time()
+    if processes > 1:
+        failed = parallel.check_matches(processes, nicknames)
+    else:
+        failed = check_matches(queue, 0, len(queue), nicknames)
+    check_time = time.time()
 
-        if local: # ignore groups
-            try:
-                result = obj.file.keymap[value]
-                if not result.section in sections:
-                    result = None
-            except KeyError:
-                pass
-        else:
-            try:
-                result = data.find_by_nickname(value, groups, sections)
-            except KeyError as msg:
-                log.error('keyerror: %s (%s)' % (msg, match))
-                result = None
-
-        if not result:
-            count = 1 + count
-            log.warn('FLData: %s doesnt match any %s from file %s (line %s)' %
-                     (value, match, obj.file.path, obj.index + index))
+    _report_matches(queue, failed)
+    end_time = time.time()
 
     log.log("Cross Reference Results: %s items, %s errors, %s seconds" %
-            (len(data.match_queue), count, time.time() - start_time))
+            (len(queue), len(failed), end_time - start_time))
+    log.log("Cross Reference Times: index %.3f, check %.3f, report %.3f seconds" %
+            (index_time - start_time, check_time - index_time, end_time - check_time))
+    diagnostics.save()
+
+
+def _touches(key, touched):
+    """_touches(key, touched)
+    Internal function. Returns True if a (groups, sections) match key can find
+    sections in any of the touched (group, section) pairs.
+    """
+    groups, sections = key
+    for group, section in touched:
+        if group in groups and (sections == (None,) or section in sections):
+            return True
+    return False
+
+
+def _load_deps(path, loaded):
+    """_load_deps(path, loaded)
+    Internal function. Loads the files queued by the loaded file at path that
+    arent loaded yet, and the files those queue in turn, taking them out of the
+    file queue. The paths of the loaded files are added to the loaded list.
+    Anything else in the file queue is left there.
+    """
+    pending = list(data.get_file_deps(path))
+    while pending:
+        group, dep = pending.pop(0)
+        dep_path = join('DATA', dep)
+        data.file_queue.discard((group, dep))
+        if group == 'fonts_dir' or data.is_loaded(dep_path):
+            continue
+        load_data_file(dep, group)
+        if data.is_loaded(dep_path):
+            loaded.append(dep_path.lower())
+            pending.extend(data.get_file_deps(dep_path))
+
+
+def _unload_orphans(deps, touched):
+    """_unload_orphans(deps, touched)
+    Internal function. Unloads the (group, path) files in deps that no loaded
+    file queues anymore, then the files only those queued, and so on. The
+    (group, section) of the unloaded sections are added to touched.
+    """
+    pending = list(deps)
+    while pending:
+        group, dep = pending.pop(0)
+        dep_path = join('DATA', dep)
+        if data.get_queued_by(group, dep) or not data.is_loaded(dep_path):
+            continue
+        children = data.get_file_deps(dep_path)
+        dep_obj = data.unload_file(dep_path)
+        touched.update([(dep_obj.group, section.section) for section in dep_obj])
+        log.info('Revalidate: unloaded %s' % dep)
+        pending.extend(children)
+
+
+def revalidate(paths):
+    """revalidate(paths)
+    Reloads changed data files (paths relative to the DATA folder, as in the
+    freelancer.ini [data] section) after everything has been loaded and
+    validated. Each file is unloaded, removing its unique keys and cross
+    references, then parsed again. Newly referenced files are loaded, and files
+    only referenced by the old version are unloaded, along with the files only
+    they referenced. Other files waiting in the file queue are not loaded.
+    Only the cross references from the reloaded and newly loaded files, and the
+    ones pointing at their sections, are checked again. Returns the number of
+    cross reference errors.
+    """
+    import time
+    start_time = time.time()
+    touched = set() # (group, section) of all unloaded and loaded sections
+    reloaded = [] # reloaded and newly referenced files
+    for filename in paths:
+        path = join('DATA', filename)
+        obj = data.get_file(path) if data.is_loaded(path) else None
+        if obj is None:
+            log.info('Revalidate: %s is not loaded' % filename)
+            continue
+        old_deps = data.get_file_deps(path)
+        data.unload_file(path)
+        touched.update([(obj.group, section.section) for section in obj])
+        load_data_file(filename, obj.group)
+        reloaded.append(path.lower())
+        _load_deps(path, reloaded)
+        # unload files nothing references anymore
+        _unload_orphans(old_deps - data.get_file_deps(path), touched)
+
+    for path in reloaded:
+        if data.is_loaded(path):
+            obj = data.get_file(path)
+            touched.update([(obj.group, section.section) for section in obj])
+            obj.parse_lazy() # lazy sections only queue their matches once parsed
+    parser.flush_checks()
+
+    # the reloaded files queued their matches again, the rest are checked if
+    # they can point at a section that was removed or added
+    files = set([id(data.get_file(path)) for path in reloaded if data.is_loaded(path)])
+    queue = [item for item in data.match_queue
+             if id(item[0].file) in files or
+             (not item[3] and _touches(_match_key(item), touched))]
+    nicknames = _build_nicknames(queue)
+    failed = check_matches(queue, 0, len(queue), nicknames)
+    _report_matches(queue, failed)
+    log.log("Revalidate Results: %s files, %s cross references, %s errors, %s seconds" %
+            (len(reloaded), len(queue), len(failed), time.time() - start_time))
+    return len(failed)
 
 
 def init(config_file='PyFL-Config.ini', minimal=False):
@@ -190,9 +438,13 @@ def init(config_file='PyFL-Config.ini', minimal=False):
     log.config(settings.general)
     log.log('------------------- PyFL Start -------------------')
     settings.validate()
+    diagnostics.load(settings.general)
     if minimal:
         return
     load_parser()
+    cache.load(settings.general)
     load_config()
+    if settings.general.get('load_on_demand', dtype=bool):
+        enable_on_demand()
     load_resources()
     hashes.generate_cache()
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# =============================================================================
+#
+#    Copyright (C) 2016  Fenris_Wolf, YSPStudios
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =============================================================================
+
+"""
+    freelancer.core.cache - On-disk snapshot of parsed data files.
+
+    The snapshot stores the freelancer.core.parallel.parse_file() results for
+    every loaded data file, keyed by the file's path, mtime, size and crc.
+    The whole snapshot is thrown away if the parser rule files or the settings
+    that change how files are parsed are different from when it was saved.
+
+    On a warm start, unchanged files are merged straight from the snapshot,
+    replaying their log messages and unique keys, so the loaded data and the
+    reported errors are the same as a full load. Only changed files are parsed.
+"""
+import os
+from os.path import join, exists
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from freelancer.files import get_file_crc, get_directory_crcs
+from freelancer.core import log
+
+CACHE_VERSION = 2
+# settings that change the results of parsing a file
+_SETTING_KEYS = ('path', 'validate_data', 'parse_referenced_files', 'match_checks',
+                 'lazy_parsing', 'diagnostics_file')
+
+_ENTRIES = None # _ENTRIES[(group, path)] = (fingerprint, pickled result), None if disabled
+_CHANGED = False
+s_general = None
+
+
+def is_enabled():
+    """is_enabled()
+    Returns True if the [General] cache_file setting is used.
+    """
+    return _ENTRIES is not None
+
+
+def _header():
+    """_header()
+    Internal function. Returns the fingerprint of the parser rules and settings
+    """
+    rules = get_directory_crcs(s_general['rules_path'])
+    options = tuple([s_general.get(key) for key in _SETTING_KEYS])
+    return (CACHE_VERSION, sorted(rules.items()), options)
+
+
+def _fingerprint(filename, referenced):
+    """_fingerprint(filename, referenced)
+    Internal function. Returns a (mtime, size, crc, references) tuple for the
+    data file, or None if it doesnt exist. references is a tuple of the
+    referenced file paths and if they exist, since validation depends on it.
+    """
+    path = join(s_general['path'], 'DATA', filename)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    refs = tuple([(ref, exists(join(s_general['path'], ref)))
+                  for ref in sorted(referenced)])
+    return (stat.st_mtime, stat.st_size, get_file_crc(path), refs)
+
+
+def load(settings):
+    """load(settings)
+    Loads the snapshot file set in the [General] cache_file setting. Discards
+    the snapshot if the parser rules or settings have changed. Normally called
+    by freelancer.core.init()
+    """
+    global _ENTRIES, _CHANGED, s_general
+    s_general = settings
+    _CHANGED = False
+    if not s_general.get('cache_file'):
+        _ENTRIES = None
+        return
+    _ENTRIES = {}
+    if not exists(s_general['cache_file']):
+        return
+    log.info('Loading Cache: %s' % s_general['cache_file'])
+    try:
+        fih = open(s_general['cache_file'], 'rb')
+        try:
+            header, entries = pickle.load(fih)
+        finally:
+            fih.close()
+    except Exception as msg: # pylint: disable=W0703
+        log.warn('Cache: unable to read %s (%s)' % (s_general['cache_file'], msg))
+        return
+    if header != _header():
+        log.info('Cache: parser rules or settings changed, discarding cache')
+        return
+    _ENTRIES = entries
+
+
+def lookup(group, filename):
+    """lookup(group, filename)
+    Returns the cached parse_file() result for the file, or None if the file
+    isnt cached or has changed since.
+    """
+    try:
+        fingerprint, result = _ENTRIES[(group, filename)]
+    except KeyError:
+        return None
+    referenced = [ref for ref, _ in fingerprint[3]]
+    if fingerprint != _fingerprint(filename, referenced):
+        return None
+    return pickle.loads(result)
+
+
+def store(group, filename, result):
+    """store(group, filename, result)
+    Stores a parse_file() result for the file. Missing files are not stored.
+    This should be called before the result is merged, so later changes to the
+    loaded data are not stored.
+    """
+    global _CHANGED
+    fingerprint = _fingerprint(filename, result[3].keys())
+    if fingerprint is None:
+        return
+    result = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+    _ENTRIES[(group, filename)] = (fingerprint, result)
+    _CHANGED = True
+
+
+def save():
+    """save()
+    Writes the snapshot file if anything new was parsed since it was loaded.
+    """
+    global _CHANGED
+    if not _CHANGED:
+        return
+    log.info('Saving Cache: %s' % s_general['cache_file'])
+    temp = '%s.tmp' % s_general['cache_file']
+    fih = open(temp, 'wb')
+    try:
+        pickle.dump((_header(), _ENTRIES), fih, pickle.HIGHEST_PROTOCOL)
+    finally:
+        fih.close()
+    if exists(s_general['cache_file']):
+        os.remove(s_general['cache_file'])
+    os.rename(temp, s_general['cache_file'])
+    _CHANGED = False
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+# =============================================================================
+#
+#    Copyright (C) 2016  Fenris_Wolf, YSPStudios
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =============================================================================
+
+"""
+    freelancer.core.compiler - Compiles the parser rules into python functions.
+
+    For each [Section] in the rule files, python source is generated for a
+    function that builds a check function for every key in the section. The
+    check functions replace LineRule.check(): the argument positions for each
+    number of values are unrolled, int/float/byte/bool/arch type checks and
+    --min/--max comparisons are inlined, and options are bound as constants.
+    The warnings are logged by the same functions as LineRule.check().
+
+    The generated code is compiled once and stored with marshal in the
+    [General] compiled_rules_file, until the rule files change.
+"""
+import os
+import sys
+import marshal
+from os.path import exists
+from freelancer.core import log, parser
+from freelancer.core.data import stats_inc, queue_match, STATS_ARGS
+from freelancer.core.regex import BOOL_RE, ARCH_RE
+from freelancer.core.tokenizer import split_args
+from freelancer.files import get_directory_crcs
+
+COMPILER_VERSION = 2
+# optional unlimited (-o with a +/* count) arguments are unrolled up to this
+# many values, lines with more use LineRule.check()
+UNROLL_LIMIT = 8
+
+# rule types with inlined checks
+_INLINE = {
+    'bool': ['if not _bool(v):'],
+    'arch': ['if not _arch(v):'],
+    'byte': ['try:',
+             '    ok = 0 <= int(v) <= 255',
+             'except ValueError:',
+             '    ok = False',
+             'if not ok:'],
+    'int': ['try:',
+            '    int(v)',
+            'except ValueError:'],
+    'float': ['try:',
+              '    float(v)',
+              'except ValueError:'],
+}
+_INLINE['ids_string'] = _INLINE['ids_html'] = _INLINE['int']
+
+
+#==============================================================================
+# code generation
+#==============================================================================
+
+def _counts(rule):
+    """_counts(rule)
+    Internal function. Returns the value counts to generate code for.
+    """
+    total = 0
+    for index, arg in enumerate(rule.args):
+        if index != rule.optional_index:
+            total += arg.count
+        elif arg.count == -1:
+            total += UNROLL_LIMIT
+        else:
+            total += arg.count
+    return range(total + 2)
+
+
+def _arg_source(rule, arg_index, position, batch):
+    """_arg_source(rule, arg_index, position, batch)
+    Internal function. Returns the lines checking the value at position
+    against the rule argument. If batch is True numeric values are added to
+    the parser's batch for flush_checks() instead.
+    """
+    arg = rule.args[arg_index]
+    options = arg.options
+    lines = ['v = data[%d]' % position]
+    warn = '    _nonmatch(%r, key, %d, v, ini, index)' % (arg.type, position)
+    if batch and arg.type in parser._NUMERIC_TYPES:
+        # checked later by parser.flush_checks()
+        lines.append('_batch.append((ini, index, key, %d, %r, v, %r, %r))' %
+                     (position, arg.type, options.get('max'), options.get('min')))
+        if options.get('match'):
+            lines.extend(_match_source(rule, options))
+        return lines
+    elif arg.type in _INLINE:
+        lines.extend(_INLINE[arg.type])
+        lines.append(warn)
+    elif arg.type == 'string':
+        pass
+    elif arg.type == 'word':
+        if options.get('regex') is not None:
+            lines.append('if not r%d(v):' % arg_index)
+            lines.append(warn)
+    else:
+        lines.append('if not _cmp[%r](v, o%d):' % (arg.type, arg_index))
+        lines.append(warn)
+
+    if options.get('max') is not None:
+        lines.append('if float(v) > %r:' % options['max'])
+        lines.append('    _above(v, key, %d, ini, index)' % position)
+    if options.get('min') is not None:
+        lines.append('if float(v) < %r:' % options['min'])
+        lines.append('    _below(v, key, %d, ini, index)' % position)
+    if options.get('match'):
+        lines.extend(_match_source(rule, options))
+    return lines
+
+
+def _match_source(rule, options):
+    """_match_source(rule, options)
+    Internal function. Returns the lines queueing a --match check.
+    """
+    return ['if match_check:',
+            '    _queue_match((ini, index, %r, %r, v.lower()))' %
+            (options['match'], rule.local_matches)]
+
+
+def _check_source(rule, batch):
+    """_check_source(rule, batch)
+    Internal function. Returns the lines of the check function body for a
+    LineRule, with a branch for each number of values.
+    """
+    branches = [] # [([counts], lines)]
+    seen = {}
+    for count in _counts(rule):
+        expected = tuple(rule._getExpected([None] * count))
+        found = min(count, len(expected))
+        key = (expected, found, count > len(expected))
+        if key in seen:
+            seen[key].append(count)
+            continue
+        seen[key] = counts = [count]
+
+        lines = []
+        if found:
+            lines.append('_stats_inc(_STATS_ARGS, %d)' % found)
+        for position in range(found):
+            lines.extend(_arg_source(rule, expected[position], position, batch))
+        if count < len(expected):
+            arg = rule.args[expected[count]]
+            lines.append('_missing(%r, key, %d, ini, index)' % (arg.type, count))
+        elif count > len(expected):
+            lines.append('_toomany(key, ini, index)')
+        lines.append('return')
+        branches.append((counts, lines))
+
+    source = ['data = _split_args(value)', 'count = len(data)']
+    for counts, lines in branches:
+        if len(counts) == 1:
+            source.append('if count == %d:' % counts[0])
+        else:
+            source.append('if count in (%s,):' % ', '.join([str(c) for c in counts]))
+        source.extend(['    %s' % line for line in lines])
+    source.append('_interpret(rule, ini, index, key, value, match_check)')
+    return source
+
+
+def _section_source(name, rules, batch):
+    """_section_source(name, rules, batch)
+    Internal function. Returns the source of a function building the check
+    functions for all the keys in a SectionRules object.
+    """
+    source = ['def %s(rules):' % name, '    checks = {}']
+    for key in sorted(rules.keys()):
+        rule = rules[key]
+        args = ['ini', 'index', 'key', 'value', 'match_check=False', 'rule=rule']
+        source.append('    rule = rules[%r]' % key)
+        for index, arg in enumerate(rule.args):
+            if arg.type == 'word' and arg.options.get('regex') is not None:
+                source.append("    r%d = rule.args[%d].options['regex'].match" % (index, index))
+                args.append('r%d=r%d' % (index, index))
+            elif arg.type not in _INLINE and arg.type != 'string':
+                source.append('    o%d = rule.args[%d].options' % (index, index))
+                args.append('o%d=o%d' % (index, index))
+        source.append('    def check(%s):' % ', '.join(args))
+        source.extend(['        %s' % line for line in _check_source(rule, batch)])
+        source.append('    checks[%r] = check' % key)
+    source.append('    return checks')
+    return source
+
+
+def generate(batch=False):
+    """generate(batch=False)
+    Returns the python source for all the loaded parser rules, defining
+    _SECTIONS[(group, section)] = function(SectionRules) -> {key: check}
+    """
+    source = ['_SECTIONS = {}']
+    for group in sorted(parser._RULES.keys()):
+        for section in sorted(parser._RULES[group].keys()):
+            name = '_section_%d' % len(source)
+            source.append('')
+            source.extend(_section_source(name, parser._RULES[group][section], batch))
+            source.append('_SECTIONS[(%r, %r)] = %s' % (group, section, name))
+    return '\n'.join(source) + '\n'
+
+
+#==============================================================================
+# loading
+#==============================================================================
+
+def _namespace():
+    """_namespace()
+    Internal function. Returns the globals the generated code runs with.
+    """
+    cmp_funcs = {}
+    for group in parser._RULES.values():
+        for rules in group.values():
+            for rule in rules.values():
+                for arg in rule.args:
+                    cmp_funcs[arg.type] = parser._checkFunc(arg.type)
+    return {
+        '_split_args': split_args,
+        '_stats_inc': stats_inc,
+        '_STATS_ARGS': STATS_ARGS,
+        '_queue_match': queue_match,
+        '_batch': parser._NUMERIC_BATCH,
+        '_interpret': parser.LineRule.check.im_func,
+        '_bool': BOOL_RE.match,
+        '_arch': ARCH_RE.match,
+        '_cmp': cmp_funcs,
+        '_missing': parser._warnMissing,
+        '_nonmatch': parser._warnNonmatch,
+        '_above': parser._warnAbove,
+        '_below': parser._warnBelow,
+        '_toomany': parser._warnTooMany,
+    }
+
+
+def _header(settings):
+    """_header(settings)
+    Internal function. Returns the fingerprint of the rule files and compiler
+    """
+    rules = get_directory_crcs(settings['rules_path'])
+    return (COMPILER_VERSION, UNROLL_LIMIT, sys.version, sorted(rules.items()),
+            parser._NUMERIC_BATCH is not None)
+
+
+def _load_code(filename, header):
+    """_load_code(filename, header)
+    Internal function. Returns the cached code object, or None.
+    """
+    if not filename or not exists(filename):
+        return None
+    try:
+        fih = open(filename, 'rb')
+        try:
+            cached_header, code = marshal.load(fih), marshal.load(fih)
+        finally:
+            fih.close()
+    except (EOFError, ValueError, TypeError, IOError):
+        return None
+    if cached_header != header:
+        return None
+    return code
+
+
+def _save_code(filename, header, code):
+    """_save_code(filename, header, code)
+    Internal function. Writes the code object to the cache file.
+    """
+    temp = '%s.tmp' % filename
+    fih = open(temp, 'wb')
+    try:
+        marshal.dump(header, fih)
+        marshal.dump(code, fih)
+    finally:
+        fih.close()
+    if exists(filename):
+        os.remove(filename)
+    os.rename(temp, filename)
+
+
+def compile_rules(settings):
+    """compile_rules(settings)
+    Compiles the loaded parser rules, replacing the check() method of every
+    LineRule with a generated function. Uses the [General] compiled_rules_file
+    setting to cache the compiled code. Normally called by parser.load_rules()
+    when the [General] compile_rules setting is true.
+    """
+    filename = settings.get('compiled_rules_file')
+    header = _header(settings)
+    code = _load_code(filename, header)
+    if code is None:
+        log.info('Compiling Rule Files')
+        code = compile(generate(parser._NUMERIC_BATCH is not None), '<compiled parser rules>', 'exec')
+        if filename:
+            try:
+                _save_code(filename, header, code)
+            except (IOError, OSError) as msg:
+                log.warn('Compiler: unable to write %s (%s)' % (filename, msg))
+
+    namespace = _namespace()
+    exec code in namespace
+    for (group, section), build in namespace['_SECTIONS'].items():
+        rules = parser._RULES[group][section]
+        for key, check in build(rules).items():
+            rules[key].check = check
@@ -23,13 +23,140 @@
 """
 
 import os
+import operator
+from fnmatch import fnmatchcase
+from collections import deque
 #import freelancer.exceptions as flex
 from freelancer.core import log
+from freelancer.core.regex import XPATH_STEP_RE, XPATH_PREDICATE_RE
+
+# file queue priorities, lower numbers are loaded first
+PRIORITY_FIRST = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LAST = 2
+# GROUP_PRIORITY[group] = priority, groups not listed are PRIORITY_NORMAL
+GROUP_PRIORITY = {
+    'universe': PRIORITY_FIRST,
+    'systems': PRIORITY_FIRST,
+    'bases': PRIORITY_FIRST,
+    'equipment': PRIORITY_FIRST,
+    'ships': PRIORITY_FIRST,
+    'goods': PRIORITY_FIRST,
+    # interface
+    'fonts': PRIORITY_LAST,
+    'rich_fonts': PRIORITY_LAST,
+    'hud': PRIORITY_LAST,
+    'navbar': PRIORITY_LAST,
+    'infocardmap': PRIORITY_LAST,
+    'keymap': PRIORITY_LAST,
+    'keylist': PRIORITY_LAST,
+    'mouse': PRIORITY_LAST,
+    'rollover': PRIORITY_LAST,
+    'buttonmontage': PRIORITY_LAST,
+    'intro': PRIORITY_LAST,
+    'cameras': PRIORITY_LAST,
+    # audio
+    'sounds': PRIORITY_LAST,
+    'soundcfg': PRIORITY_LAST,
+    'voices': PRIORITY_LAST,
+}
+
+
+class FileQueue(object):
+    """FileQueue()
+    Queue of (group, path) files to load. Files are taken out in order of their
+    group's priority in GROUP_PRIORITY, then in the order they were queued.
+    Files already waiting in the queue are not added again.
+    """
+    def __init__(self):
+        self._queues = {} # _queues[priority] = deque of (group, path)
+        self._queued = set()
+
+    def __len__(self):
+        return len(self._queued)
+
+    def __contains__(self, item):
+        return item in self._queued
+
+    def __iter__(self):
+        """iterates the files in the order they will be taken out"""
+        for priority in sorted(self._queues):
+            for item in self._queues[priority]:
+                yield item
+
+    def append(self, item):
+        """FileQueue.append(item)
+        Adds a (group, path) tuple to the end of its group's priority.
+        Returns False if its already queued.
+        """
+        if item in self._queued:
+            return False
+        self._queued.add(item)
+        priority = GROUP_PRIORITY.get(item[0], PRIORITY_NORMAL)
+        try:
+            self._queues[priority].append(item)
+        except KeyError:
+            self._queues[priority] = deque([item])
+        return True
+
+    def priority(self):
+        """FileQueue.priority()
+        Returns the priority of the next file, or None if the queue is empty.
+        """
+        for priority in sorted(self._queues):
+            if self._queues[priority]:
+                return priority
+        return None
+
+    def pop(self):
+        """FileQueue.pop()
+        Removes and returns the next (group, path) tuple. Raises IndexError if
+        the queue is empty.
+        """
+        priority = self.priority()
+        if priority is None:
+            raise IndexError('pop from empty FileQueue')
+        item = self._queues[priority].popleft()
+        self._queued.discard(item)
+        return item
+
+    def take(self, group):
+        """FileQueue.take(group)
+        Removes and returns a list of the queued (group, path) tuples for a
+        group, in queue order.
+        """
+        queue = self._queues.get(GROUP_PRIORITY.get(group, PRIORITY_NORMAL))
+        if not queue:
+            return []
+        items = [item for item in queue if item[0] == group]
+        if items:
+            keep = [item for item in queue if item[0] != group]
+            queue.clear()
+            queue.extend(keep)
+            self._queued.difference_update(items)
+        return items
+
+    def discard(self, item):
+        """FileQueue.discard(item)
+        Removes a (group, path) tuple from the queue if its queued.
+        """
+        if item not in self._queued:
+            return
+        self._queued.discard(item)
+        self._queues[GROUP_PRIORITY.get(item[0], PRIORITY_NORMAL)].remove(item)
+
+    def clear(self):
+        """FileQueue.clear()
+        Removes all the queued files.
+        """
+        self._queues.clear()
+        self._queued.clear()
+
 
 # all loaded Ini files
 _LOADED = {} # _LOADED[file path] = IniFile()
 # queue of files to load
-file_queue = [] # file_queue[index] = (group, path)
+file_queue = FileQueue()
 # queue of nicknames to match
 match_queue = []
 # files
@@ -44,6 +171,24 @@ _REFERENCED = {} # _REFERENCED[path] = int
 _UNIQUE = {}
 _GROUP_UNIQUE = {}
 
+# events deferred while parsing in a worker process (see freelancer.core.parallel)
+# None when loading normally. _DEFERRED[index] = (event, args...)
+_DEFERRED = None
+
+# file dependencies, recorded by queue_file() while a data file is parsed
+_PARSING = None # path of the file being parsed (lowercase), None if not parsing
+_FILE_DEPS = {} # _FILE_DEPS[path] = set of (group, path) queued by the file
+_FILE_REFS = {} # _FILE_REFS[path] = {referenced path: count} added by the file
+
+# on demand group loading (see freelancer.core.enable_on_demand())
+_GROUP_LOADER = None # function(group) called by get_group(), None when disabled
+
+# compiled xpath() queries
+XPATH_CACHE_SIZE = 256
+_XPATH_PLANS = {} # _XPATH_PLANS[path] = _xpath_compile() result
+_XPATH_TYPES = {'bool': bool, 'int': int, 'float': float, 'str': str}
+_XPATH_NUMERIC = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+
 # Stats handling
 _STATS = [0, 0, 0, 0, 0, 0, 0] # [time, files parsed, lines parsed, sections, keys, args, errors]
 STATS_TIME = 0
@@ -77,12 +222,23 @@ class FLKeyError(FLDataError):
         FLDataError.__init__(self, 'FLData (%s:%s): %s' % (group, section, message))
 
 
+def _load_group(group):
+    """_load_group(group)
+    Internal function. Loads a group if on demand loading is enabled, unless
+    a file is being parsed.
+    """
+    if _GROUP_LOADER is not None and _PARSING is None and _DEFERRED is None:
+        _GROUP_LOADER(group)
+
+
 def get_group(group, create=False):
     """get_group(group)
     Returns a dict of DataSection() groups, where keys are the section names,
-    and values are dict objects.
+    and values are dict objects. When on demand loading is enabled, the group's
+    files are loaded first.
     """
     group = group.lower()
+    _load_group(group)
     if create is True:
         _DATA[group] = _DATA.get(group, {})
     try:
@@ -146,6 +302,26 @@ def find_by_nickname(sortkey, groups=None, sections=None):
 
     return results
 
+def get_nicknames(groups=None, sections=None):
+    """get_nicknames(groups=None, sections=None)
+    Returns a set of the sortkeys find_by_nickname() would find a DataSection()
+    for, with the same groups and sections filters. Raises a KeyError if one of
+    the groups isnt loaded.
+    """
+    result = set()
+    if groups is None or groups == (None,):
+        groups = _DATA.keys()
+
+    for group in groups:
+        group_dict = _DATA[group]
+        new_sections = sections
+        if new_sections is None or new_sections == (None,):
+            new_sections = group_dict.keys()
+
+        for section in new_sections:
+            result.update(group_dict.get(section, ()))
+    return result
+
 #==============================================================================
 #
 #==============================================================================
@@ -183,20 +359,80 @@ def queue_match(data):
     match_queue.append(data)
 
 def queue_file(group, path):
-    if (group, path) in file_queue:
+    if _DEFERRED is not None:
+        _DEFERRED.append(('queue', group, path))
         return
-    log.debug("File Queue: Appending (group: %s, path: %s)" % (group, path))
-    file_queue.append((group, path))
+    _FILE_DEPS.setdefault(_PARSING, set()).add((group, path))
+    if file_queue.append((group, path)):
+        log.debug("File Queue: Appending (group: %s, path: %s)" % (group, path))
+
+def get_file_deps(path):
+    """get_file_deps(path)
+    Returns a set of the (group, path) files queued while parsing the loaded
+    file at path. Files queued by freelancer.ini are under the path None.
+    """
+    if path is not None:
+        path = path.lower()
+    return set(_FILE_DEPS.get(path, ()))
+
+
+def get_queued_by(group, path):
+    """get_queued_by(group, path)
+    Returns a set of the loaded file paths that queued the file, None meaning
+    freelancer.ini or a script.
+    """
+    return set([parent for parent, deps in _FILE_DEPS.items()
+                if (group, path) in deps])
+
+
+def unload_file(path):
+    """unload_file(path)
+    Removes a loaded file and everything it registered: its global, group and
+    section unique keys, its match queue items, its file dependencies and its
+    file references.
+    Returns the removed file object, or None if it wasnt loaded.
+    """
+    path = path.lower()
+    obj = _LOADED.pop(path, None)
+    if obj is None:
+        return None
+    _FILE_DEPS.pop(path, None)
+    for ref, count in _FILE_REFS.pop(path, {}).items():
+        count = _REFERENCED.get(ref, 0) - count
+        if count > 0:
+            _REFERENCED[ref] = count
+        else:
+            _REFERENCED.pop(ref, None)
+    match_queue[:] = [item for item in match_queue if item[0].file is not obj]
+
+    sections = set([id(section) for section in obj])
+    def discard(keys):
+        for key, value in keys.items():
+            if id(value) in sections:
+                del keys[key]
+    discard(_UNIQUE)
+    discard(_GROUP_UNIQUE.get(obj.group, {}))
+    group = _DATA.get(obj.group, {})
+    for section in set([section.section for section in obj]):
+        discard(group.get(section, {}))
+    return obj
+
 
 def dequeue_file():
-    return file_queue.pop(0)
+    return file_queue.pop()
 
 
 def add_reference(path):
     _REFERENCED[path] = 1 + _REFERENCED.get(path, 0)
+    if _DEFERRED is None: # merged per file by parallel.merge_file()
+        refs = _FILE_REFS.setdefault(_PARSING, {})
+        refs[path] = 1 + refs.get(path, 0)
 
 
 def add_unique_global_key(key, value):
+    if _DEFERRED is not None:
+        _DEFERRED.append(('uglobal', key, value))
+        return
     if _UNIQUE.has_key(key):
         stats_inc(STATS_ERRORS)
         raise FLSectionError("Duplicate global unique '%s' in file %s (line %s)" %
@@ -204,6 +440,9 @@ def add_unique_global_key(key, value):
     _UNIQUE[key] = value
 
 def add_unique_group_key(key, value):
+    if _DEFERRED is not None:
+        _DEFERRED.append(('ugroup', key, value))
+        return
     _GROUP_UNIQUE[value.group] = _GROUP_UNIQUE.get(value.group, {})
     gu = _GROUP_UNIQUE[value.group]
     if gu.has_key(key):
@@ -213,11 +452,14 @@ def add_unique_group_key(key, value):
     gu[key] = value
 
 def add_unique_section_key(key, value):
+    if _DEFERRED is not None:
+        _DEFERRED.append(('usection', key, value))
+        return
     _DATA[value.group] = _DATA.get(value.group, {})
     data = _DATA[value.group]
     data[value.section] = data.get(value.section, {})
     data = data[value.section]
-    if data.get(key):
+    if key in data:
         stats_inc(STATS_ERRORS)
         raise FLSectionError("Duplicate group:section unique '%s' in file %s (line %s)" %
                              (key, value.file.path, value.index), value.group, value.section)
@@ -236,42 +478,175 @@ def stats_inc(stat, value=1):
 #
 #==============================================================================
 
+def _xpath_compile(path):
+    """_xpath_compile(path)
+    Internal function. Parses a xpath() query into a tuple of steps, each a
+    (name, is_pattern, predicates, dtype) tuple. Raises a ValueError if the
+    query is invalid.
+    """
+    steps = path.strip().strip('/')
+    steps = steps and steps.split('/') or []
+    if len(steps) > 4:
+        raise ValueError("Invalid xpath '%s': too many steps" % path)
+    plan = []
+    for depth, step in enumerate(steps):
+        match = XPATH_STEP_RE.match(step.strip())
+        if match is None:
+            raise ValueError("Invalid xpath step '%s' in '%s'" % (step, path))
+        name, predicates, dtype = match.groups()
+        name = name.strip().lower()
+        if predicates and depth not in (1, 2):
+            raise ValueError("Invalid xpath '%s': predicates are only allowed on "
+                             "section and nickname steps" % path)
+        if dtype is not None:
+            if depth != 3 or dtype.lower() not in _XPATH_TYPES:
+                raise ValueError("Invalid xpath '%s': bad type '%s'" % (path, dtype))
+            dtype = _XPATH_TYPES[dtype.lower()]
+        if XPATH_PREDICATE_RE.sub('', predicates):
+            raise ValueError("Invalid xpath predicate in step '%s' of '%s'" % (step, path))
+        tests = []
+        for key, op, value in XPATH_PREDICATE_RE.findall(predicates):
+            value = value.lower()
+            if op in _XPATH_NUMERIC:
+                try:
+                    value = float(value)
+                except ValueError:
+                    raise ValueError("Invalid xpath '%s': %s%s needs a number" %
+                                     (path, key, op))
+            tests.append((key.lower(), op or None, value))
+        plan.append((name, '*' in name or '?' in name, tuple(tests), dtype))
+    return tuple(plan)
+
+
+def _xpath_select(values, name, is_pattern):
+    """_xpath_select(values, name, is_pattern)
+    Internal function. Yields the values of the dict for the name, matching
+    all keys if the name is a wildcard pattern.
+    """
+    if not is_pattern:
+        value = values.get(name)
+        if value is not None:
+            yield value
+        return
+    for key, value in values.items():
+        if fnmatchcase(key, name):
+            yield value
+
+
+def _xpath_test(section, tests):
+    """_xpath_test(section, tests)
+    Internal function. Returns True if the section passes all the predicates.
+    """
+    for key, op, expected in tests:
+        value = section.get(key)
+        if value is None:
+            return False
+        if op is None:
+            continue
+        if not isinstance(value, list):
+            value = [value]
+        if op in _XPATH_NUMERIC:
+            passed = False
+            for item in value:
+                try:
+                    if _XPATH_NUMERIC[op](float(item), expected):
+                        passed = True
+                        break
+                except ValueError:
+                    continue
+        else:
+            passed = False
+            for item in value:
+                if fnmatchcase(item.lower(), expected):
+                    passed = True
+                    break
+            if op == '!=':
+                passed = not passed
+        if not passed:
+            return False
+    return True
+
+
+def _xpath_run(plan):
+    """_xpath_run(plan)
+    Internal function. Generator for the results of a compiled xpath() query.
+    """
+    depth = len(plan)
+    if depth == 0:
+        yield _DATA
+        return
+    group_step, section_step, name_step, key_step = plan + (None,) * (4 - depth)
+    if not group_step[1]:
+        _load_group(group_step[0])
+    tests = section_step and section_step[2] or ()
+    if name_step:
+        tests += name_step[2]
+
+    for group in _xpath_select(_DATA, *group_step[:2]):
+        if section_step is None:
+            yield group
+            continue
+        for sections in _xpath_select(group, *section_step[:2]):
+            if name_step is None:
+                found = sections.itervalues()
+            else:
+                found = _xpath_select(sections, *name_step[:2])
+            for section in found:
+                if tests and not _xpath_test(section, tests):
+                    continue
+                if key_step is None:
+                    yield section
+                    continue
+                key, is_pattern, _, dtype = key_step
+                if is_pattern:
+                    keys = [k for k in section.keys() if fnmatchcase(k, key)]
+                elif section.has_key(key):
+                    keys = [key]
+                else:
+                    continue
+                for key in keys:
+                    yield section.get(key, dtype=dtype)
+
+
 def xpath(path):
     """xpath(path)
-    xpath style data lookup. 'path' is a string represented like:
+    xpath style data lookup. Returns a generator of the results for 'path',
+    a string represented like:
     xpath('/group/section/name/key')
     examples:
-    
-    xpath('/equipment') - returns the equipment data group
 
-    xpath('/equipment/thruster') - returns all thrusters from the 
+    xpath('/equipment') - yields the equipment data group
+
+    xpath('/equipment/thruster') - yields all thrusters from the
             equipment data group
-            
-    xpath('/equipment/thruster/my_thruster) - returns the thruster with the 
+
+    xpath('/equipment/thruster/my_thruster') - yields the thruster with the
         nickname 'my_thruster'
-        
-    xpath('/equipment/thruster/my_thruster/mass) - returns my_thruster's mass
+
+    xpath('/equipment/thruster/my_thruster/mass') - yields my_thruster's mass
         as a string
 
-    xpath('/equipment/thruster/my_thruster/mass=float) - returns my_thruster's mass
-        as a float
+    xpath('/equipment/thruster/my_thruster/mass=float') - yields my_thruster's
+        mass as a float (bool, int, float and str can be used). Like
+        IniSection.get() values that cant be converted are left as strings.
+
+    Any step can be a wildcard pattern such as '*' or 'li01_*'. Groups are only
+    loaded on demand for steps without wildcards. Section and nickname steps
+    can be filtered by predicates on the section's keys, and sections
+    without a key are skipped:
+
+    xpath('/universe/system[pos]') - systems with a pos key
+    xpath('/equipment/gun/*[hp_gun_type=hp_gun_special_*]') - string match,
+        with wildcards. != is also supported.
+    xpath('/equipment/gun/*[hit_pts>=100][mass<10]') - numeric comparisons
+
+    Queries are parsed once and cached. Raises a ValueError if the query is
+    invalid.
     """
-    raise NotImplementedError
-    path = path.split('/')
-    result = None
-    arglen = len(path)
-    if arglen == 0:
-        return _DATA
-    elif arglen == 1:
-        return get_group(path[0])
-    elif arglen == 2:
-        return get_sections(*path[0:2])
-    result = get_key(*path[0:3])
-    if arglen == 4:
-        try:
-            key, dtype = path[3].split('=')
-            dtype = {'bool':bool, 'int':int, 'float':float}.get(dtype, None)
-        except ValueError:
-            key, dtype = path[3], None
-        result = result.get(key, dtype=dtype)
-    return result
+    try:
+        plan = _XPATH_PLANS[path]
+    except KeyError:
+        if len(_XPATH_PLANS) >= XPATH_CACHE_SIZE:
+            _XPATH_PLANS.clear()
+        plan = _XPATH_PLANS[path] = _xpath_compile(path)
+    return _xpath_run(plan)
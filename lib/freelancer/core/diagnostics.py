@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+# =============================================================================
+#
+#    Copyright (C) 2016  Fenris_Wolf, YSPStudios
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =============================================================================
+
+"""
+    freelancer.core.diagnostics - Collects data validation problems.
+
+    Validation problems are reported with report(code, path, line, *args)
+    where code is one of the constants below, and args are the values for the
+    code's message. By default each one is formatted and logged straight away,
+    same as log.warn().
+
+    When the [General] diagnostics_file setting is used they are stored
+    unformatted in arrays instead, and written out all at once by save() in
+    the diagnostics_format: text (the same messages as the log), json (one
+    json object per line) or sarif. Duplicates are only written once, and a
+    count for each code is logged.
+"""
+import json
+import logging
+from array import array
+from freelancer.core import log, data
+
+MISSING_VALUE = 1
+NONMATCHING_VALUE = 2
+ABOVE_MAX = 3
+BELOW_MIN = 4
+TOO_MANY_VALUES = 5
+UNKNOWN_SECTION = 6
+BAD_LINE = 7
+UNKNOWN_KEY = 8
+NOT_MULTILINE = 9
+MISSING_REQUIRED_KEY = 10
+MISSING_SORT_KEY = 11
+DUPLICATE_LOCAL_UNIQUE = 12
+NO_MATCH = 13
+
+# _CODES[code] = (name, level, message, argument names). The message is
+# formatted with the arguments followed by the file path and line
+_CODES = {
+    MISSING_VALUE: ('missing-value', logging.WARN,
+                    "FLData: Missing %s value (key:%s arg:#%s) in file %s (line %s)",
+                    ('type', 'key', 'arg')),
+    NONMATCHING_VALUE: ('nonmatching-value', logging.WARN,
+                        "FLData: Non matching %s value (key:%s arg:#%s) '%s' in file %s (line %s)",
+                        ('type', 'key', 'arg', 'value')),
+    ABOVE_MAX: ('above-max', logging.WARN,
+                "FLData: Value %s is above max (key:%s arg:#%s) in file %s (line %s)",
+                ('value', 'key', 'arg')),
+    BELOW_MIN: ('below-min', logging.WARN,
+                "FLData: Value %s is below min (key:%s arg:#%s) in file %s (line %s)",
+                ('value', 'key', 'arg')),
+    TOO_MANY_VALUES: ('too-many-values', logging.WARN,
+                      "FLData: Too many values for key %s in file %s (line %s)",
+                      ('key',)),
+    UNKNOWN_SECTION: ('unknown-section', logging.WARN,
+                      "FLData: (%s:%s) Unknown section in file %s (line %s)",
+                      ('group', 'section')),
+    BAD_LINE: ('bad-line', logging.WARN,
+               "FLData: Bad line in file %s (line %s)",
+               ()),
+    UNKNOWN_KEY: ('unknown-key', logging.WARN,
+                  "FLData: (%s:%s) Unknown key '%s = %s' in file %s (line %s)",
+                  ('group', 'section', 'key', 'value')),
+    NOT_MULTILINE: ('not-multiline', logging.WARN,
+                    "FLData: (%s:%s) Key '%s' is not multiline in file %s (line %s)",
+                    ('group', 'section', 'key')),
+    MISSING_REQUIRED_KEY: ('missing-required-key', logging.WARN,
+                           "FLData: (%s:%s) Missing Required key '%s' in file %s (line %s)",
+                           ('group', 'section', 'key')),
+    MISSING_SORT_KEY: ('missing-sort-key', logging.WARN,
+                       "FLData: (%s:%s) Missing required sort key '%s' in file %s (line %s)",
+                       ('group', 'section', 'key')),
+    DUPLICATE_LOCAL_UNIQUE: ('duplicate-local-unique', logging.WARN,
+                             "FLData: Duplicate Local Unique '%s' in file %s (line %s)",
+                             ('value',)),
+    NO_MATCH: ('no-match', logging.WARN,
+               "FLData: %s doesnt match any %s from file %s (line %s)",
+               ('value', 'match')),
+}
+
+FORMATS = ('text', 'json', 'sarif')
+
+# the collected diagnostics, each is stored at the same index of the arrays
+# and the args list
+_ENABLED = False
+_LEVEL = logging.WARN
+_CODE = None # array of codes
+_PATH = None # array of indexes in _PATHS
+_LINE = None # array of line numbers
+_ARGS = None # list of argument tuples
+_PATHS = None # list of file paths
+_PATH_INDEX = None # _PATH_INDEX[path] = index in _PATHS
+_COUNTS = None # _COUNTS[code] = number reported
+s_general = None
+
+
+def is_enabled():
+    """is_enabled()
+    Returns True if diagnostics are being collected instead of logged.
+    """
+    return _ENABLED
+
+
+def load(settings):
+    """load(settings)
+    Enables collecting diagnostics if the [General] diagnostics_file setting is
+    used, clearing any already collected. Only diagnostics at or above the
+    current log level are kept. Normally called by freelancer.core.init()
+    """
+    global _ENABLED, _LEVEL, s_general
+    s_general = settings
+    _ENABLED = bool(settings.get('diagnostics_file'))
+    _LEVEL = logging.getLogger().getEffectiveLevel()
+    clear()
+
+
+def clear():
+    """clear()
+    Discards all collected diagnostics.
+    """
+    global _CODE, _PATH, _LINE, _ARGS, _PATHS, _PATH_INDEX, _COUNTS
+    _CODE = array('B')
+    _PATH = array('L')
+    _LINE = array('l')
+    _ARGS = []
+    _PATHS = []
+    _PATH_INDEX = {}
+    _COUNTS = array('L', [0] * (max(_CODES) + 1))
+
+
+def report(code, path, line, *args):
+    """report(code, path, line, *args)
+    Reports a validation problem in a file. args are the values for the code's
+    message. Logs the message, or stores it if collecting diagnostics.
+    """
+    if not _ENABLED:
+        # dont format messages the log level would throw away
+        if log._root.isEnabledFor(logging.WARN):
+            log.warn(_CODES[code][2] % (args + (path, line)))
+        return
+    if data._DEFERRED is not None:
+        # filtered by level when replayed, the log level may change by then
+        data._DEFERRED.append(('diag', code, path, line, args))
+        return
+    if _CODES[code][1] < _LEVEL:
+        return
+    add(code, path, line, args)
+
+
+def add(code, path, line, args):
+    """add(code, path, line, args)
+    Stores a diagnostic. Normally called through report()
+    """
+    try:
+        path_index = _PATH_INDEX[path]
+    except KeyError:
+        path_index = _PATH_INDEX[path] = len(_PATHS)
+        _PATHS.append(path)
+    _CODE.append(code)
+    _PATH.append(path_index)
+    _LINE.append(line)
+    _ARGS.append(args)
+    _COUNTS[code] += 1
+
+
+def counts():
+    """counts()
+    Returns a dict of the number of each diagnostic reported, by code name.
+    Duplicates are included.
+    """
+    return dict([(_CODES[code][0], count) for code, count in enumerate(_COUNTS)
+                 if count])
+
+
+def iter_diagnostics(unique=True):
+    """iter_diagnostics(unique=True)
+    Yields a (code, path, line, args) tuple for each collected diagnostic in the
+    order they were reported. If unique is True duplicates are skipped.
+    """
+    seen = set()
+    for index, code in enumerate(_CODE):
+        item = (code, _PATHS[_PATH[index]], _LINE[index], _ARGS[index])
+        if unique:
+            if item in seen:
+                continue
+            seen.add(item)
+        yield item
+
+
+def format_message(code, path, line, args):
+    """format_message(code, path, line, args)
+    Returns the log message for a diagnostic.
+    """
+    return _CODES[code][2] % (args + (path, line))
+
+
+def _json_item(code, path, line, args):
+    """_json_item(code, path, line, args)
+    Internal function. Returns a dict for the json format.
+    """
+    name, level, _, arg_names = _CODES[code]
+    item = {'code': name, 'level': logging.getLevelName(level).lower(),
+            'file': path, 'line': line,
+            'message': format_message(code, path, line, args)}
+    item.update(zip(arg_names, args))
+    return item
+
+
+def render_text(unique=True):
+    """render_text(unique=True)
+    Yields each collected diagnostic as a line of text, same as the log message.
+    """
+    for item in iter_diagnostics(unique):
+        yield '%s\n' % format_message(*item)
+
+
+def render_json(unique=True):
+    """render_json(unique=True)
+    Yields each collected diagnostic as a line of json.
+    """
+    for item in iter_diagnostics(unique):
+        yield '%s\n' % json.dumps(_json_item(*item), sort_keys=True)
+
+
+def render_sarif(unique=True):
+    """render_sarif(unique=True)
+    Returns the collected diagnostics as a SARIF 2.1.0 log, as a string.
+    """
+    used = sorted(set(_CODE))
+    rules = [{'id': _CODES[code][0],
+              'shortDescription': {'text': _CODES[code][2]}} for code in used]
+    rule_index = dict([(code, index) for index, code in enumerate(used)])
+    results = []
+    for code, path, line, args in iter_diagnostics(unique):
+        results.append({
+            'ruleId': _CODES[code][0],
+            'ruleIndex': rule_index[code],
+            'level': _CODES[code][1] >= logging.ERROR and 'error' or 'warning',
+            'message': {'text': format_message(code, path, line, args)},
+            'locations': [{'physicalLocation': {
+                'artifactLocation': {'uri': path.replace('\\', '/')},
+                'region': {'startLine': max(1, line)}}}],
+        })
+    sarif = {
+        '$schema': 'https://json.schemastore.org/sarif-2.1.0.json',
+        'version': '2.1.0',
+        'runs': [{'tool': {'driver': {'name': 'PyFL', 'rules': rules}},
+                  'results': results}],
+    }
+    return json.dumps(sarif, indent=2, sort_keys=True)
+
+
+def save(filename=None, fmt=None):
+    """save(filename=None, fmt=None)
+    Writes the collected diagnostics to the file, by default the [General]
+    diagnostics_file in the diagnostics_format, and logs the count for each
+    code. Does nothing if diagnostics are not being collected.
+    """
+    if not _ENABLED:
+        return
+    filename = filename or s_general['diagnostics_file']
+    fmt = (fmt or s_general.get('diagnostics_format') or 'text').lower()
+    if fmt not in FORMATS:
+        log.error('Diagnostics: unknown format %s, using text' % fmt)
+        fmt = 'text'
+
+    log.info('Saving Diagnostics: %s' % filename)
+    fih = open(filename, 'w')
+    try:
+        if fmt == 'sarif':
+            fih.write(render_sarif())
+        elif fmt == 'json':
+            fih.writelines(render_json())
+        else:
+            fih.writelines(render_text())
+    finally:
+        fih.close()
+    for name, count in sorted(counts().items()):
+        log.log('Diagnostics: %s %s' % (count, name))
@@ -58,6 +58,54 @@ def exception(msg):
 def log(msg):
     _root.log(35, msg)
 
+def replay(level, msg):
+    _root.log(level, msg)
+
+
+class _CaptureHandler(logging.Handler):
+    """_CaptureHandler(events)
+    Internal class. Stores log records as ('log', level, message) tuples in the
+    events list instead of writing them out.
+    """
+    def __init__(self, events):
+        logging.Handler.__init__(self)
+        self.events = events
+
+    def emit(self, record):
+        self.events.append(('log', record.levelno, record.getMessage()))
+
+
+def capture(events):
+    """capture(events)
+    Removes all log handlers and stores any further log messages in the events
+    list, so they can be replayed later in order with replay(). Messages of
+    every level are stored, replay() filters them by the log level at that
+    time. Returns the removed handlers and log level, which should be passed
+    to release() when done.
+    """
+    handlers = _root.handlers[:]
+    for handler in handlers:
+        _root.removeHandler(handler)
+    _root.addHandler(_CaptureHandler(events))
+    level = _root.level
+    _root.setLevel(logging.DEBUG)
+    return handlers, level
+
+def release(captured):
+    """release(captured)
+    Stops capturing log messages, restoring the handlers and log level
+    returned by capture()
+    """
+    handlers, level = captured
+    _root.setLevel(level)
+    for handler in _root.handlers[:]:
+        _root.removeHandler(handler)
+    for handler in handlers:
+        _root.addHandler(handler)
+
+def set_level(level):
+    _root.setLevel(level)
+
 def config(options):
     global _file, _format
     level = options.get('log_level', 'INFO').upper()
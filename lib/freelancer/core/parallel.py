@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+# =============================================================================
+#
+#    Copyright (C) 2016  Fenris_Wolf, YSPStudios
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =============================================================================
+
+"""
+    freelancer.core.parallel - Multi-process loading of the file queue.
+
+    Each worker process reads and parses a single data file with
+    freelancer.core.data in deferred mode: anything that touches the shared
+    data (unique keys, queued files, log messages) is recorded as a event
+    instead. The main process merges the parsed IniFile objects and replays
+    their events in the same order as freelancer.core.load_queue() would,
+    so errors and duplicate keys are reported the same way.
+"""
+import os
+from os.path import join
+import multiprocessing
+import freelancer.files.ini as ini
+from freelancer.core import data, parser, settings, log, cache, diagnostics
+
+_NICKNAMES = None # nickname sets for check_matches() workers
+
+
+def _init_worker(general, level):
+    """_init_worker(general, level)
+    Internal function. Initializes a worker process, loading the parser rules
+    if the process was not forked from the main one.
+    """
+    settings.general = general
+    ini.s_general = general
+    log.set_level(level)
+    if not parser._RULES:
+        parser.load_rules(general)
+        diagnostics.load(general)
+
+
+def parse_file(group, filename):
+    """parse_file(group, filename)
+    Loads a single data file in deferred mode, isolated from the already loaded
+    data. Returns a tuple of (IniFile, events, stats, referenced, match_queue)
+    to be passed to merge_file()
+    """
+    saved = (data._LOADED, data._DATA, data._REFERENCED, data.match_queue,
+             data.file_queue, data._STATS)
+    events = []
+    data._LOADED, data._DATA, data._REFERENCED = {}, {}, {}
+    data.match_queue, data.file_queue = [], data.FileQueue()
+    data._STATS = [0 for _ in saved[5]]
+    data._DEFERRED = events
+    handlers = log.capture(events)
+    path = join('DATA', filename)
+    flags = ini.FLAG_FLDATA + ini.FLAG_LOG + ini.FLAG_STAT
+    if settings.general.get('lazy_parsing', dtype=bool):
+        flags += ini.FLAG_LAZY
+    if settings.general.get('mmap_files', dtype=bool):
+        flags += ini.FLAG_MMAP
+    try:
+        try:
+            ini.IniFile(path,
+                        directory=settings.general['path'],
+                        group=group,
+                        flags=flags)
+        except ini.FileReadError:
+            pass
+        parser.flush_checks()
+        # on read errors the file is still registered, same as a normal load
+        return (data._LOADED.get(path.lower()), events, data._STATS,
+                data._REFERENCED, data.match_queue)
+    finally:
+        log.release(handlers)
+        data._DEFERRED = None
+        (data._LOADED, data._DATA, data._REFERENCED, data.match_queue,
+         data.file_queue, data._STATS) = saved
+
+
+def merge_file(result):
+    """merge_file(result)
+    Adds the results of parse_file() to the loaded data, replaying the deferred
+    events.
+    """
+    obj, events, stats, referenced, matches = result
+    if obj is not None:
+        data.add_file(obj.path, obj)
+        data._PARSING = obj.path.lower() # for files queued by this one
+
+    for event in events:
+        if event[0] == 'log':
+            log.replay(event[1], event[2])
+        elif event[0] == 'diag':
+            diagnostics.report(event[1], event[2], event[3], *event[4])
+        elif event[0] == 'queue':
+            data.queue_file(event[1], event[2])
+        elif event[0] == 'uglobal':
+            try:
+                data.add_unique_global_key(event[1], event[2])
+            except data.FLSectionError:
+                pass # already handled
+        elif event[0] == 'ugroup':
+            try:
+                data.add_unique_group_key(event[1], event[2])
+            except data.FLGroupError:
+                pass # already handled
+        elif event[0] == 'usection':
+            try:
+                data.add_unique_section_key(event[1], event[2])
+            except data.FLSectionError:
+                pass # already handled
+    data._PARSING = None
+
+    for index, value in enumerate(stats):
+        if index != data.STATS_TIME:
+            data.stats_inc(index, value)
+    for path, count in referenced.items():
+        data._REFERENCED[path] = count + data._REFERENCED.get(path, 0)
+    if obj is not None:
+        data._FILE_REFS[obj.path.lower()] = dict(referenced)
+    data.match_queue.extend(matches)
+
+
+class _CachedResult(object):
+    """_CachedResult(result)
+    Internal class. Wraps a result from the cache so it can be used in place of
+    a multiprocessing AsyncResult.
+    """
+    def __init__(self, result):
+        self.result = result
+
+    def ready(self):
+        return True
+
+    def successful(self):
+        return True
+
+    def get(self):
+        return self.result
+
+
+def load_queue(processes=None, priority=None):
+    """load_queue(processes=None, priority=None)
+    Loads all files in the queue using a pool of worker processes. If processes
+    is None, the number of cpus is used. Files referenced while parsing are
+    sent to the pool as soon as a worker finds them, but results are always
+    merged in queue order. Unchanged files are taken from the cache if its
+    enabled. If priority is given only files with that priority or a lower
+    number are loaded, see freelancer.core.load_queue()
+    """
+    pool = multiprocessing.Pool(processes, _init_worker,
+                                (settings.general, log._root.level))
+    pending = {} # pending[(group, path)] = AsyncResult
+    scanned = set() # results already checked for referenced files
+
+    def submit(group, path):
+        if group == 'fonts_dir' or (group, path) in pending:
+            # fonts_dir is in freelancer.ini, but points to a directory not file.
+            return
+        if priority is not None and \
+                data.GROUP_PRIORITY.get(group, data.PRIORITY_NORMAL) > priority:
+            return
+        if data.is_loaded(join('DATA', path)):
+            return
+        if cache.is_enabled():
+            result = cache.lookup(group, path)
+            if result is not None:
+                pending[(group, path)] = _CachedResult(result)
+                return
+        pending[(group, path)] = pool.apply_async(parse_file, (group, path))
+
+    try:
+        files = data.file_queue
+        while len(files) > 0:
+            if priority is not None and files.priority() > priority:
+                break
+            for item in files:
+                submit(*item)
+
+            # send referenced files from finished workers to the pool early
+            for item, result in pending.items():
+                if item in scanned or not result.ready():
+                    continue
+                scanned.add(item)
+                if not result.successful():
+                    continue
+                for event in result.get()[1]:
+                    if event[0] == 'queue':
+                        submit(event[1], event[2])
+
+            key = files.pop()
+            result = pending.pop(key, None)
+            scanned.discard(key)
+            if result is None or data.is_loaded(join('DATA', key[1])):
+                continue
+            if cache.is_enabled() and not isinstance(result, _CachedResult):
+                cache.store(key[0], key[1], result.get())
+            merge_file(result.get())
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _check_range(bounds):
+    """_check_range(bounds)
+    Internal function. Checks a (start, end) range of the match queue in a
+    worker process, using the queue and nickname sets inherited by the fork.
+    """
+    from freelancer import core
+    return core.check_matches(data.match_queue, bounds[0], bounds[1], _NICKNAMES)
+
+
+def check_matches(processes, nicknames):
+    """check_matches(processes, nicknames)
+    Checks the match queue with a pool of worker processes, see
+    freelancer.core.check_matches(). The queue is split into ranges that the
+    workers read from the forked copy of the loaded data, so only the failed
+    queue indexes are sent back. Checks in this process if os.fork() isnt
+    available, since the queue would have to be pickled.
+    """
+    global _NICKNAMES
+    from freelancer import core
+    queue = data.match_queue
+    if not hasattr(os, 'fork') or len(queue) < processes:
+        return core.check_matches(queue, 0, len(queue), nicknames)
+
+    size = len(queue) // (processes * 4) + 1
+    ranges = [(start, min(start + size, len(queue)))
+              for start in xrange(0, len(queue), size)]
+    _NICKNAMES = nicknames # inherited by the forked workers
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_check_range, ranges)
+    finally:
+        _NICKNAMES = None
+        pool.terminate()
+        pool.join()
+    failed = []
+    for result in results:
+        failed.extend(result)
+    return failed
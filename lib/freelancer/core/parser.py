@@ -26,11 +26,19 @@
 
 import re
 import os
-from os.path import join, exists
+from os.path import join, relpath
 from collections import namedtuple
+try:
+    import numpy
+except ImportError:
+    numpy = None
 from freelancer.core import log
 from freelancer.core.data import add_reference, queue_match, queue_file, stats_inc, STATS_ARGS
 from freelancer.core.regex import *
+from freelancer.core.tokenizer import split_args
+from freelancer.core.diagnostics import (report, MISSING_VALUE, NONMATCHING_VALUE,
+                                         ABOVE_MAX, BELOW_MIN, TOO_MANY_VALUES)
+from freelancer.files import DirectoryIndex
 
 # Parsing rules
 _RULES = {} # _RULES[group][section] = SectionRules()
@@ -47,6 +55,13 @@ HASH_UNIQUE = 16
 
 RuleArg = namedtuple('RuleArg', ('type', 'count', 'options'))
 s_general = None # set in freelancer.core.init()
+_FILE_INDEX = None # DirectoryIndex of the FL path, built on first use
+# rule types checked in bulk by flush_checks() when the [General]
+# vectorize_checks setting is true and numpy is installed
+_NUMERIC_TYPES = frozenset(('int', 'float', 'byte', 'ids_string', 'ids_html'))
+_NUMERIC_BATCH = None # [(ini, index, key, expected_index, type, value, max, min), ...]
+_MATCH_SPECS = {} # _MATCH_SPECS[-m option] = parse_match() result
+_QUEUEING = True # False while check_unqueued() is running
 
 #==============================================================================
 #
@@ -72,6 +87,7 @@ class SectionRules(dict):
     section = None
     sortkey = None # the type of sortkey used. bitwise flags
     required = None
+    references = False # True if any key can reference a ini file to load
 
     def __init__(self, group, section, lines):
         if _RULES[group].has_key(section):
@@ -97,6 +113,8 @@ class SectionRules(dict):
                 self.sortkey = key
                 break
         self.required = tuple([k for k, v in self.items() if v.required])
+        self.references = True in [arg.type == 'ini' for v in self.values()
+                                   for arg in v.args]
 
 
 
@@ -116,6 +134,7 @@ class LineRule(object):
     args = None # tuple of RuleArg objects (these are named tuples)
     local_matches = False
     optional_index = None # the index of a RuleArg with the -o option specified
+    _plans = None # _plans[number of values] = plan from _getPlan()
 
 
     def __init__(self, value, group, section, key):
@@ -176,62 +195,102 @@ class LineRule(object):
 
             args.append(RuleArg(rule_type, count, options))
         self.args = tuple(args)
+        self._plans = {}
 
 
-    def check(self, ini, index, key, value, match_check=False):
+    def check(self, ini, index, key, value, match_check=False, vectorize=True):
         """LineRule.check(ini, index, key, value)
         Compares the data in a FL ini line with the rules associated with the
         Group:Section:Key. It is not nessessary to manually call this method, it
         is called automatically when parsing a DataFile and freelancer.settings.validate_rules
-        is set to True.
+        is set to True. If vectorize is False numeric arguments are checked
+        right away instead of being left for flush_checks().
         """
-        data = COMMA_SPLIT_RE.split(value)
-        expected = self._getExpected(data)
-
-        for expected_index, arg_index in enumerate(expected):
-            arg = self.args[arg_index]
-            options = arg.options
-            call = _checkFunc(arg.type) # our checking function to call
+        data = split_args(value)
+        plan = self._getPlan(len(data))
+        batch = _NUMERIC_BATCH
+        if not vectorize:
+            batch = None
 
+        for expected_index, (rule_type, call, options, vmax, vmin, match) in enumerate(plan):
             try:
                 value = data[expected_index]
             except IndexError:
                 # TODO: inc error count
-                log.warn("FLData: Missing %s value (key:%s arg:#%s) in file %s (line %s)" % 
-                         (arg.type, key, expected_index, ini.file.path, index + ini.index))
+                _warnMissing(rule_type, key, expected_index, ini, index)
                 break
 
             stats_inc(STATS_ARGS, 1) # increment total # of args
-            if not call(value, options):
-                # TODO: inc error count
-                log.warn("FLData: Non matching %s value (key:%s arg:#%s) '%s' in file %s (line %s)" % 
-                         (arg.type, key, expected_index, value, ini.file.path, index + ini.index))
+            if batch is not None and rule_type in _NUMERIC_TYPES:
+                # checked later by flush_checks()
+                batch.append((ini, index, key, expected_index, rule_type, value, vmax, vmin))
+            else:
+                if not call(value, options):
+                    # TODO: inc error count
+                    _warnNonmatch(rule_type, key, expected_index, value, ini, index)
+                if vmax is not None and float(value) > vmax:
+                    # TODO: inc error count
+                    _warnAbove(value, key, expected_index, ini, index)
+                    #ini.error(index, "Value %s is above max (%s #%s) '%s'" % (value, key, expected_index, value))
+                if vmin is not None and float(value) < vmin:
+                    # TODO: inc error count
+                    _warnBelow(value, key, expected_index, ini, index)
+                    #ini.error(index, "Value %s is below min (%s #%s) '%s'" % (value, key, expected_index, value))
             #else:
             #    if call == _cmpIdsString:
             #        resources.addNameRef(int(value), ini, index, expected_index)
             #    elif call == _cmpIdsHtml:
             #        resources.addInfoRef(int(value), ini, index, expected_index)
 
+            if match and match_check:
+                queue_match((ini, index, match, self.local_matches, value.lower()))
 
-            if options.get('max') is not None and float(value) > options['max']:
-                # TODO: inc error count
-                log.warn("FLData: Value %s is above max (key:%s arg:#%s) in file %s (line %s)" % 
-                         (value, key, expected_index, ini.file.path, index + ini.index))
-                #ini.error(index, "Value %s is above max (%s #%s) '%s'" % (value, key, expected_index, value))
-            if options.get('min') is not None and float(value) < options['min']:
+        if len(data) > len(plan):
                 # TODO: inc error count
-                log.warn("FLData: Value %s is below min (key:%s arg:#%s) in file %s (line %s)" % 
-                         (value, key, expected_index, ini.file.path, index + ini.index))
-                #ini.error(index, "Value %s is below min (%s #%s) '%s'" % (value, key, expected_index, value))
+            _warnTooMany(key, ini, index)
+            #ini.error(index, "Too many values on line")
 
-            if options.get('match') and match_check:
-                queue_match((ini, index, options['match'], self.local_matches, value.lower()))
 
-        if len(data) > len(expected):
-                # TODO: inc error count
-            log.warn("FLData: Too many values for key %s in file %s (line %s)" %
-                     (key, ini.file.path, index + ini.index))
-            #ini.error(index, "Too many values on line")
+    def _getPlan(self, count):
+        """LineRule._getPlan(count)
+        Internal method. Returns the plan for checking a line with count values:
+        a tuple of (type, check function, options, max, min, match) for each
+        expected value. Plans are built by _getExpected() once per value count.
+        """
+        try:
+            return self._plans[count]
+        except KeyError:
+            pass
+        plan = []
+        for arg_index in self._getExpected([None] * count):
+            arg = self.args[arg_index]
+            options = arg.options
+            plan.append((arg.type, _checkFunc(arg.type), options, options.get('max'),
+                         options.get('min'), options.get('match')))
+        self._plans[count] = plan = tuple(plan)
+        return plan
+
+
+    def convert(self, value):
+        """LineRule.convert(value)
+        Splits a FL ini line value by commas, and converts each argument to the
+        python type of the rule argument it matches: int for int, byte and ids
+        arguments, float for float and True/False for bool. Anything else, or
+        values that dont match their type, are left as strings. Returns a tuple.
+        """
+        data = split_args(value)
+        plan = self._getPlan(len(data))
+        result = []
+        for index, value in enumerate(data):
+            if index < len(plan):
+                call = _CONVERT.get(plan[index][0])
+                if call is not None:
+                    try:
+                        value = call(value)
+                    except ValueError:
+                        pass
+            result.append(value)
+        return tuple(result)
 
 
     def _getExpected(self, data):
@@ -267,6 +326,38 @@ class LineRule(object):
         return compare
 
 
+def _warnMissing(rule_type, key, expected_index, ini, index):
+    """_warnMissing(rule_type, key, expected_index, ini, index)
+    Internal function. Reports a missing rule argument.
+    """
+    report(MISSING_VALUE, ini.file.path, index + ini.index, rule_type, key, expected_index)
+
+def _warnNonmatch(rule_type, key, expected_index, value, ini, index):
+    """_warnNonmatch(rule_type, key, expected_index, value, ini, index)
+    Internal function. Reports a value not matching its rule argument type.
+    """
+    report(NONMATCHING_VALUE, ini.file.path, index + ini.index,
+           rule_type, key, expected_index, value)
+
+def _warnAbove(value, key, expected_index, ini, index):
+    """_warnAbove(value, key, expected_index, ini, index)
+    Internal function. Reports a value above the --max option.
+    """
+    report(ABOVE_MAX, ini.file.path, index + ini.index, value, key, expected_index)
+
+def _warnBelow(value, key, expected_index, ini, index):
+    """_warnBelow(value, key, expected_index, ini, index)
+    Internal function. Reports a value below the --min option.
+    """
+    report(BELOW_MIN, ini.file.path, index + ini.index, value, key, expected_index)
+
+def _warnTooMany(key, ini, index):
+    """_warnTooMany(key, ini, index)
+    Internal function. Reports a line with more values than its rule allows.
+    """
+    report(TOO_MANY_VALUES, ini.file.path, index + ini.index, key)
+
+
 def _parseOption(opt, group, section, key):
     """_parseOption(opt)
     Internal function. Called when building a LineRule object. Validates a - or --
@@ -367,6 +458,27 @@ def _checkFunc(rule_type):
         return _cmpString
     return None
 
+def _toBool(val):
+    """_toBool(val)
+    Internal function. Converts a rule bool argument to True/False
+    """
+    val = val.lower()
+    if val in ('1', 'true'):
+        return True
+    elif val in ('0', 'false'):
+        return False
+    raise ValueError(val)
+
+# functions converting rule argument types, used by LineRule.convert()
+_CONVERT = {
+    'bool': _toBool,
+    'byte': int,
+    'int': int,
+    'float': float,
+    'ids_string': int,
+    'ids_html': int,
+}
+
 def _cmpBool(val, opt):
     """_cmpBool(val, opt)
     Internal function. Used for rule bool argument comparison.
@@ -443,17 +555,21 @@ def _cmpFile(val, opt):
     Adds file to the referenced list.
     """
     path = join('data', opt.get('dir', '').lower(), val.lower())
-    add_reference(path)
-    return exists(join(s_general['path'], path))
+    if _QUEUEING:
+        add_reference(path)
+    return path in get_file_index()
 
 def _cmpIni(val, opt):
     """_cmpIni(val, opt)
     Internal function. Used for rule ini argument comparison.
     Adds file to the referenced list, and loads it if parse_referenced_files is set.
+    The file is queued by its real path on disk, relative to the data folder.
     """
     if _cmpFile(val, opt):
-        if s_general.get('parse_referenced_files', False, dtype=bool):
-            pth = join(opt.get('dir', '').lower(), val.lower())
+        if _QUEUEING and s_general.get('parse_referenced_files', False, dtype=bool):
+            index = get_file_index()
+            pth = index.find(join('data', opt.get('dir', ''), val))
+            pth = relpath(pth, index.find('data'))
             queue_file(opt.get('template').lower(), pth)
         return True
     return False
@@ -501,9 +617,164 @@ def _cmpString(val, opt):
     """
     return True
 
+def check_unqueued(rule, ini, index, key, value):
+    """check_unqueued(rule, ini, index, key, value)
+    Checks a line the same as LineRule.check(), but without queueing anything
+    that keeps a reference to the section: no -m cross reference checks,
+    numeric checks for flush_checks(), referenced files or file references.
+    Used for the sections of iter_sections(), which arent kept.
+    """
+    global _QUEUEING
+    _QUEUEING = False
+    try:
+        # the class method, compiled rules always batch numeric arguments
+        LineRule.check(rule, ini, index, key, value, vectorize=False)
+    finally:
+        _QUEUEING = True
+
+def get_file_index():
+    """get_file_index()
+    Returns the case insensitive DirectoryIndex of the [General] path used to
+    check file references, scanning the directory the first time.
+    """
+    global _FILE_INDEX
+    if _FILE_INDEX is None or _FILE_INDEX.path != s_general['path']:
+        _FILE_INDEX = DirectoryIndex(s_general['path'])
+    return _FILE_INDEX
+
+def refresh_file_index():
+    """refresh_file_index()
+    Updates the file index if files were added or removed since it was built.
+    Returns True if it was rebuilt.
+    """
+    if _FILE_INDEX is None:
+        return False
+    return _FILE_INDEX.refresh()
+
+def _convertAll(values, dtype, convert):
+    """_convertAll(values, dtype, convert)
+    Internal function. Converts a numpy array of strings to dtype, then
+    to float. Returns a (array, valid) tuple, valid being a bool array of the
+    values that converted. If any fail they are converted one at a time with
+    convert() instead, same as the _cmp functions.
+    """
+    try:
+        result = values.astype(dtype)
+        return result.astype(numpy.float64), numpy.ones(len(values), bool)
+    except (ValueError, OverflowError):
+        pass
+    result = numpy.zeros(len(values))
+    valid = numpy.zeros(len(values), bool)
+    for index, value in enumerate(values):
+        try:
+            convert(value)
+        except ValueError:
+            continue
+        valid[index] = True
+        result[index] = float(value)
+    return result, valid
+
+def flush_checks():
+    """flush_checks()
+    Checks the numeric rule arguments collected by LineRule.check() when the
+    [General] vectorize_checks setting is used, logging the same warnings.
+    The type, byte range and --min/--max checks are done on whole arrays at
+    once. Values that fail their type check are rechecked one at a time.
+    Called automatically after loading files.
+    """
+    if not _NUMERIC_BATCH:
+        return
+    batch = _NUMERIC_BATCH[:]
+    del _NUMERIC_BATCH[:]
+
+    _, _, _, _, types, values, vmax, vmin = zip(*batch)
+    types = numpy.array(types)
+    values = numpy.array(values)
+    floats = types == 'float'
+    numbers = numpy.zeros(len(batch))
+    valid = numpy.zeros(len(batch), bool)
+    for mask, dtype, convert in ((floats, numpy.float64, float),
+                                 (~floats, numpy.int64, int)):
+        where = numpy.flatnonzero(mask)
+        if not len(where):
+            continue
+        result, ok = _convertAll(values[where], dtype, convert)
+        numbers[where] = result
+        valid[where] = ok
+
+    # missing --min/--max options (None) become nan, which never compare True
+    vmax = numpy.array(vmax, numpy.float64)
+    vmin = numpy.array(vmin, numpy.float64)
+    with numpy.errstate(invalid='ignore'):
+        valid &= (types != 'byte') | ((numbers >= 0) & (numbers <= 255))
+        above = numbers > vmax
+        below = numbers < vmin
+
+    for item_index in numpy.flatnonzero(~valid | above | below):
+        ini, index, key, expected_index, rule_type, value, imax, imin = batch[item_index]
+        if not valid[item_index]:
+            _warnNonmatch(rule_type, key, expected_index, value, ini, index)
+            # same as LineRule.check(), the value may not be a number at all
+            if imax is not None and float(value) > imax:
+                _warnAbove(value, key, expected_index, ini, index)
+            if imin is not None and float(value) < imin:
+                _warnBelow(value, key, expected_index, ini, index)
+            continue
+        if above[item_index]:
+            _warnAbove(value, key, expected_index, ini, index)
+        if below[item_index]:
+            _warnBelow(value, key, expected_index, ini, index)
+
+def parse_match(match):
+    """parse_match(match)
+    Splits a -m/--match rule option ('group|group:section|section') into a
+    (groups, sections) tuple. groups is a tuple of group names, or None if the
+    option has no groups (the group of the file with the match). sections is a
+    tuple of section names, or (None,) for any section. Raises a ValueError if
+    the option is invalid. Each option is only parsed once.
+    """
+    try:
+        return _MATCH_SPECS[match]
+    except KeyError:
+        pass
+    parsed = MATCH_RE.match(match.lower())
+    if parsed is None:
+        raise ValueError("Invalid match option: %s" % match)
+    groups, sections = parsed.groups()
+    if groups:
+        groups = tuple(groups.split('|'))
+    if sections:
+        sections = tuple(sections.split('|'))
+    else:
+        sections = (None,)
+    _MATCH_SPECS[match] = result = (groups or None, sections)
+    return result
+
 def get_rules(group, section):
     return _RULES[group][section]
 
+def get_group_dependencies(group):
+    """get_group_dependencies(group)
+    Returns a (templates, matches) tuple of sets for a rule group. templates
+    are the groups of the ini files queued by its -t options, matches are the
+    groups its -m options check against, including the group itself for
+    options without a group. Local matches are skipped.
+    """
+    templates, matches = set(), set()
+    for rules in _RULES.get(group, {}).values():
+        for rule in rules.values():
+            for arg in rule.args:
+                if arg.options.get('template'):
+                    templates.add(arg.options['template'].lower())
+                if not arg.options.get('match') or rule.local_matches:
+                    continue
+                try:
+                    groups = parse_match(arg.options['match'])[0]
+                except ValueError:
+                    continue
+                matches.update(groups or (group,))
+    return templates, matches
+
 def load_rule_file(path, filename):
     """load_rule_file(filename)
     Mostly Internal function. Called by load_rules() to load a specific rule file"""
@@ -545,7 +816,7 @@ def load_rule_file(path, filename):
 def load_rules(settings):
     """load_rules()
     Loads all parser rule .ini files"""
-    global s_general
+    global s_general, _NUMERIC_BATCH
     s_general = settings
     path = s_general['rules_path']
     files = os.listdir(path)
@@ -554,3 +825,14 @@ def load_rules(settings):
             continue
         load_rule_file(path, name)
 
+    _NUMERIC_BATCH = None
+    if s_general.get('vectorize_checks', dtype=bool):
+        if numpy is None:
+            log.info('Parser: numpy not installed, vectorize_checks disabled')
+        else:
+            _NUMERIC_BATCH = []
+
+    if s_general.get('compile_rules', dtype=bool):
+        from freelancer.core import compiler
+        compiler.compile_rules(s_general)
+
@@ -38,5 +38,8 @@ BOOL_RE = re.compile(r'^(?:1|0|true|false)$', re.I) # parser rule bool
 ARCH_RE = re.compile(r'^(?:0x[0-9a-z]+|-?[0-9]+)$') # parser rule archetype
 WORD_RE = re.compile(r'^\w+$') # parser rule word
 STRING_RE = re.compile('^.+$') # parser rule string
+MATCH_RE = re.compile(r'([^\:]+)?\:([^\:]+)?') # parser rule -m option 'groups:sections'
+XPATH_STEP_RE = re.compile(r'^([^\[\]=]+)((?:\[[^\]]*\])*)(?:=(\w+))?$') # data.xpath() 'name[pred]=type'
+XPATH_PREDICATE_RE = re.compile(r'\[ *([^\]=!<> ]+) *(?:(!=|<=|>=|=|<|>) *([^\]]*?) *)?\]') # '[key op value]'
 
 COMMA_SPLIT_RE = re.compile(' *, *')
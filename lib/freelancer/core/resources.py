@@ -50,6 +50,7 @@ except ImportError:
     pass
 
 from freelancer.core import settings, log, tools
+from freelancer.files import map_lines
 from freelancer.files.ini import IniSection
 
 BLOCK_RE = re.compile(r'^([SH]) ([0-9]+)(?: (~))?(?:\W+(.+))?$')
@@ -260,11 +261,13 @@ class FrcFile(ResourceFile):
         filename = "%s.frc" % join(path, self.name)
         if not exists(filename):
             raise ResourceError('Resource File Missing: %s' % filename)
-        fih = open(filename, 'r')
-        lines = []
-        lines = fih.read()
-        fih.close()
-        lines = lines.splitlines()
+        if s_general.get('mmap_files', dtype=bool):
+            lines = (line for _, line in map_lines(filename))
+        else:
+            fih = open(filename, 'r')
+            lines = fih.read()
+            fih.close()
+            lines = lines.splitlines()
 
         last_comments = []
         last_block = None
@@ -41,6 +41,17 @@ _DEFAULTS = {
         'validate_data' : 'true',
         'parse_referenced_files' : 'true',
         'match_checks': 'true',
+        'load_processes': '1',
+        'match_processes': '1',
+        'load_on_demand': 'false',
+        'lazy_parsing': 'false',
+        'mmap_files': 'false',
+        'compile_rules': 'false',
+        'vectorize_checks': 'false',
+        'diagnostics_format': 'text',
+        'watch_interval': '1.0',
+        'watch_inotify': 'false',
+        'compiled_rules_file': 'PyFL-Rules.cache',
         'log_file' : 'PyFL.log',
         'log_stdout' : 'true',
         'log_level' : 'warn',
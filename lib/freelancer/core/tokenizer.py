@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# =============================================================================
+#
+#    Copyright (C) 2016  Fenris_Wolf, YSPStudios
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =============================================================================
+
+"""
+    freelancer.core.tokenizer - Single pass ini line tokenizer.
+
+    Classifies a ini line as a [section] header, blank/comment, 'key = value'
+    or bad line, and splits it into the key, value and comment. This does the
+    same job as the SECTION_RE, LINE_COMMENT_RE, LINE_SPLIT_RE and
+    COMMA_SPLIT_RE regexes in freelancer.core.regex with the same results,
+    but only scans each line once. Lines are expected to be rstripped.
+"""
+import string
+
+LINE_BLANK = 0 # blank line
+LINE_COMMENT = 1 # comment only
+LINE_SECTION = 2 # [section] header
+LINE_KEY = 3 # key = value
+LINE_BAD = 4 # not blank, but not a valid 'key = value' line
+
+# characters not matched by the regex \W
+_WORD_CHARS = frozenset(string.ascii_letters + string.digits + '_')
+
+
+def section_name(line):
+    """section_name(line)
+    Returns the name of the [section] if the line is a section header, or None
+    Same as SECTION_RE.match(line).group(1)
+    """
+    if line[:1] != '[':
+        line = line.lstrip(' ')
+        if line[:1] != '[':
+            return None
+    end = line.find(']')
+    if end < 2:
+        return None
+    rest = line[end+1:].lstrip(' ')
+    if rest and rest[0] != ';':
+        return None
+    return line[1:end]
+
+
+def is_blank(line):
+    """is_blank(line)
+    Returns True if the line is blank or only a comment.
+    Same as not LINE_COMMENT_RE.sub('', line)
+    """
+    line = line.lstrip(' \t')
+    return not line or line[0] == ';'
+
+
+def split_line(line):
+    """split_line(line)
+    Splits a 'key = value ; comment' line and returns a (key, value, comment)
+    tuple, or None if its not a valid line. comment is None if the line has no
+    comment. Same as LINE_SPLIT_RE.match(line).groups()
+    """
+    equals = line.find('=')
+    if equals < 1:
+        return None
+    key = line[:equals]
+    if ';' in key:
+        return None
+    key = key.rstrip(' ') or key[0]
+
+    value = line[equals+1:].lstrip(' ')
+    if not value:
+        return None
+    comment = value.find(';', 1)
+    if comment == -1:
+        return key, value, None
+    # the comment also takes any non word characters before the ;
+    while comment > 1 and value[comment-1] not in _WORD_CHARS:
+        comment -= 1
+    return key, value[:comment], value[comment:]
+
+
+def split_args(value):
+    """split_args(value)
+    Splits a value by commas, removing spaces around them. Returns a list.
+    Same as COMMA_SPLIT_RE.split(value) for values returned by split_line()
+    """
+    if ',' not in value:
+        return [value]
+    return [arg.strip(' ') for arg in value.split(',')]
+
+
+def tokenize(line):
+    """tokenize(line)
+    Classifies and splits a ini line, returning a (type, key, value, comment)
+    tuple where type is one of LINE_BLANK, LINE_COMMENT, LINE_SECTION, LINE_KEY
+    or LINE_BAD. For section headers key is the section name.
+    """
+    stripped = line.lstrip(' \t')
+    if not stripped:
+        return LINE_BLANK, None, None, None
+    if stripped[0] == ';':
+        return LINE_COMMENT, None, None, None
+    if stripped[0] == '[':
+        name = section_name(line)
+        if name is not None:
+            return LINE_SECTION, name, None, None
+    split = split_line(line)
+    if split is None:
+        return LINE_BAD, None, None, None
+    return (LINE_KEY,) + split
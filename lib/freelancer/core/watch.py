@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+# =============================================================================
+#
+#    Copyright (C) 2016  Fenris_Wolf, YSPStudios
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =============================================================================
+
+"""
+    freelancer.core.watch - Reloads data files when they change on disk.
+
+    A Watcher checks the loaded data files for changes, and reloads the changed
+    ones with freelancer.core.revalidate(), which swaps the new IniFile into the
+    loaded data and removes the old unique keys. Subscribers are then called
+    with the sections that were removed and added.
+
+    Changes are found by polling the mtime and size of each loaded file. With
+    the [General] watch_inotify setting and pyinotify installed, inotify events
+    for the DATA folder are used instead, so only the files in the events are
+    checked.
+
+    Example:
+        watcher = Watcher()
+        watcher.subscribe(on_change)
+        watcher.start() # check in a background thread
+"""
+import os
+import threading
+from os.path import join
+from freelancer.core import data, log, settings
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+_DATA_PREFIX = 'data' + os.sep
+
+
+class SectionChanges(object):
+    """SectionChanges(path, old, new)
+    The changes to a reloaded data file, passed to Watcher subscribers.
+    path is the file path relative to the DATA folder, old and new are the
+    IniFile objects before and after (either may be None if the file was
+    unloaded or could not be read). removed is a list of the old sections that
+    were changed or deleted, added is a list of the new sections that were
+    changed or created. Sections are compared by name and lines.
+    """
+    def __init__(self, path, old, new):
+        self.path = path
+        self.old = old
+        self.new = new
+        old_keys = {}
+        for section in old or ():
+            key = (section.section, tuple(section.lines))
+            old_keys[key] = old_keys.get(key, 0) + 1
+        self.added = []
+        for section in new or ():
+            key = (section.section, tuple(section.lines))
+            if old_keys.get(key):
+                old_keys[key] -= 1
+            else:
+                self.added.append(section)
+        self.removed = [section for section in old or ()
+                        if old_keys.get((section.section, tuple(section.lines)))]
+
+    def __repr__(self):
+        return '<SectionChanges %s: %s removed, %s added>' % (
+            self.path, len(self.removed), len(self.added))
+
+
+class Watcher(object):
+    """Watcher(interval=None, inotify=None)
+    Watches the loaded data files for changes. interval is the number of
+    seconds between checks (default: the [General] watch_interval setting).
+    If inotify is True (default: the [General] watch_inotify setting) and
+    pyinotify is installed, inotify events are used to find changed files
+    instead of polling all of them.
+    """
+    interval = 1.0
+    _notifier = None # pyinotify.Notifier, None when polling
+    _events = None # set of full paths from inotify events
+    _thread = None
+    _stop = None
+
+    def __init__(self, interval=None, inotify=None):
+        if interval is None:
+            interval = settings.general.get('watch_interval', 1.0, dtype=float)
+        if inotify is None:
+            inotify = settings.general.get('watch_inotify', False, dtype=bool)
+        self.interval = interval
+        self._subscribers = []
+        self._sources = {} # _sources[loaded path] = (mtime, size)
+        self._lock = threading.Lock()
+        self.snapshot()
+        if inotify and pyinotify is None:
+            log.info('Watch: pyinotify not installed, polling for changes')
+        elif inotify:
+            self._start_inotify()
+
+
+    def subscribe(self, callback):
+        """Watcher.subscribe(callback)
+        Adds a function to call after files are reloaded. It is called with a
+        list of SectionChanges objects, one for each reloaded file.
+        """
+        self._subscribers.append(callback)
+
+
+    def unsubscribe(self, callback):
+        """Watcher.unsubscribe(callback)
+        Removes a function added with subscribe()
+        """
+        self._subscribers.remove(callback)
+
+
+    @staticmethod
+    def _stat(obj):
+        try:
+            stat = os.stat(obj.fullpath)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size)
+
+
+    def snapshot(self):
+        """Watcher.snapshot()
+        Records the mtime and size of all the loaded data files, as the state
+        to compare with. Files loaded after this are added by check()
+        """
+        self._sources = {}
+        for path, obj in data._LOADED.items():
+            if obj is not None and path.startswith(_DATA_PREFIX):
+                self._sources[path] = self._stat(obj)
+
+
+    def _candidates(self):
+        """Watcher._candidates()
+        Internal method. Returns the loaded paths that may have changed, all of
+        them when polling, or the ones with inotify events.
+        """
+        if self._notifier is None:
+            return [path for path in data._LOADED if path.startswith(_DATA_PREFIX)]
+        if self._notifier.check_events(0):
+            self._notifier.read_events()
+            self._notifier.process_events()
+        events = self._events
+        self._events = set()
+        fullpaths = dict([(os.path.normcase(os.path.abspath(obj.fullpath)), path)
+                          for path, obj in data._LOADED.items()
+                          if obj is not None and path.startswith(_DATA_PREFIX)])
+        candidates = [fullpaths[name] for name in events if name in fullpaths]
+        # files loaded since the last check
+        candidates.extend([path for path in fullpaths.values() if path not in self._sources])
+        return candidates
+
+
+    def check(self):
+        """Watcher.check()
+        Reloads the data files that changed since the last check, and calls
+        the subscribers. Returns a list of SectionChanges, empty if nothing
+        changed.
+        """
+        from freelancer import core
+        with self._lock:
+            changed = []
+            for path in self._candidates():
+                obj = data._LOADED.get(path)
+                if obj is None:
+                    continue
+                source = self._stat(obj)
+                if path not in self._sources:
+                    self._sources[path] = source
+                elif self._sources[path] != source:
+                    changed.append((path, obj))
+            if not changed:
+                return []
+
+            for path, obj in changed:
+                log.info('Watch: %s changed' % obj.path)
+            core.revalidate([obj.path[len(_DATA_PREFIX):] for path, obj in changed])
+
+            results = []
+            for path, old in changed:
+                new = data._LOADED.get(path)
+                self._sources[path] = new is not None and self._stat(new) or None
+                results.append(SectionChanges(old.path[len(_DATA_PREFIX):], old, new))
+            # drop files revalidate() unloaded
+            for path in self._sources.keys():
+                if path not in data._LOADED:
+                    del self._sources[path]
+
+        for callback in self._subscribers[:]:
+            callback(results)
+        return results
+
+
+    def run(self):
+        """Watcher.run()
+        Checks for changes every interval seconds until stop() is called.
+        """
+        self._stop = threading.Event()
+        while not self._stop.is_set():
+            try:
+                self.check()
+            except Exception: # pylint: disable=W0703
+                log.exception('Watch: error reloading files')
+            self._stop.wait(self.interval)
+
+
+    def start(self):
+        """Watcher.start()
+        Runs the watcher in a background thread. Subscribers are called from
+        that thread, so the loaded data should not be used from other threads
+        while it checks.
+        """
+        self._thread = threading.Thread(target=self.run, name='PyFL Watch')
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def stop(self):
+        """Watcher.stop()
+        Stops a watcher started with run() or start(), and waits for it.
+        """
+        if self._stop is not None:
+            self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        if self._notifier is not None:
+            self._notifier.stop()
+            self._notifier = None
+
+
+    def _start_inotify(self):
+        """Watcher._start_inotify()
+        Internal method. Watches the DATA folder with inotify.
+        """
+        self._events = set()
+        watcher = self
+
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                # _candidates() swaps in a new set, so read it from the watcher
+                watcher._events.add(os.path.normcase(os.path.abspath(event.pathname)))
+
+        manager = pyinotify.WatchManager()
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_DELETE
+        self._notifier = pyinotify.Notifier(manager, Handler(), timeout=0)
+        manager.add_watch(join(settings.general['path'], 'DATA'), mask, rec=True,
+                          auto_add=True)
@@ -23,11 +23,16 @@
 """
 
 
+import re
 import shutil
 import json
+import mmap
 import os
-from os.path import join, dirname, exists
+from os.path import join, dirname, exists, normpath, relpath
 from zlib import crc32
+
+_BARE_CR_RE = re.compile(r'\r(?!\n)') # mac style line ending
+_LINE_END_RE = re.compile(r'\r\n|\r|\n')
 #from freelancer.core import log
 
 def list_directory(path):
@@ -65,6 +70,111 @@ def json_save(path, data):
     fih.close()
 
 
+def map_lines(path):
+    """map_lines(path)
+    Yields a (byte offset, line) tuple for each line in a file, scanning the
+    line endings through a read only mmap of the file instead of reading it
+    all into memory. Lines end in '\n', '\r\n' or '\r' the same as
+    str.splitlines(), the line endings are not included.
+    """
+    fih = open(path, 'rb')
+    try:
+        try:
+            data = mmap.mmap(fih.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError): # empty files cant be mapped
+            return
+        try:
+            pos = 0
+            size = len(data)
+            if _BARE_CR_RE.search(data) is not None:
+                # slower, but only needed for files with '\r' line endings
+                for match in _LINE_END_RE.finditer(data):
+                    yield pos, data[pos:match.start()]
+                    pos = match.end()
+                if pos < size:
+                    yield pos, data[pos:]
+                return
+            while pos < size:
+                end = data.find('\n', pos)
+                if end == -1:
+                    end = size
+                if end > pos and data[end-1] == '\r':
+                    yield pos, data[pos:end-1]
+                else:
+                    yield pos, data[pos:end]
+                pos = end + 1
+        finally:
+            data.close()
+    finally:
+        fih.close()
+
+
+class DirectoryIndex(object):
+    """DirectoryIndex(path)
+    A case insensitive index of the files and directories under path, built
+    with a single recursive scan. Lookups use the lowercased path relative to
+    path, with either / or \\ separators, and return the real path on disk.
+    """
+    path = None
+    _entries = None # _entries[lowercase relative path] = real path
+    _dirs = None # _dirs[real directory path] = mtime
+
+    def __init__(self, path):
+        self.path = path
+        self.scan()
+
+
+    @staticmethod
+    def _key(path):
+        return normpath(path.replace('\\', '/')).lower()
+
+
+    def scan(self):
+        """DirectoryIndex.scan()
+        Rebuilds the index from the files on disk.
+        """
+        entries = {}
+        dirs = {}
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            try:
+                dirs[dirpath] = os.stat(dirpath).st_mtime
+            except OSError:
+                continue
+            rel = relpath(dirpath, self.path)
+            for name in dirnames + filenames:
+                entries[self._key(join(rel, name))] = join(dirpath, name)
+        self._entries = entries
+        self._dirs = dirs
+
+
+    def refresh(self):
+        """DirectoryIndex.refresh()
+        Rescans if any directory was modified (files added, removed or renamed)
+        since the last scan. Only the directories are checked, not every file.
+        Returns True if the index was rebuilt.
+        """
+        for dirpath, mtime in self._dirs.iteritems():
+            try:
+                changed = os.stat(dirpath).st_mtime != mtime
+            except OSError:
+                changed = True
+            if changed:
+                self.scan()
+                return True
+        return False
+
+
+    def find(self, path):
+        """DirectoryIndex.find(path)
+        Returns the real path of a file or directory, or None if it doesnt exist.
+        """
+        return self._entries.get(self._key(path))
+
+
+    def __contains__(self, path):
+        return self._key(path) in self._entries
+
+
 def get_file_crc(path):
     """Returns the CRC value for the specified file"""
     fih = open(path, 'rb')
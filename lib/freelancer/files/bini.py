@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+# =============================================================================
+#
+#    Copyright (C) 2016  Fenris_Wolf, YSPStudios
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =============================================================================
+
+"""
+    freelancer.files.bini - reading and writing BINI compressed ini files.
+
+    BINI files are Freelancer's binary version of its ini files. The layout is:
+
+    header: 'BINI', uint32 version (1), uint32 offset of the string table
+    [section]: uint16 name offset, uint16 number of entries
+        entry: uint16 name offset, uint8 number of values
+            value: uint8 type (1 int, 2 float, 3 string), 4 byte int32,
+                   float32 or int32 string offset
+    string table: null terminated strings, offsets are relative to its start
+
+    decode() turns the binary data into the same lines as a text ini file, so
+    IniFile can parse it normally. encode() does the reverse.
+"""
+import re
+import struct
+from freelancer.core.tokenizer import (tokenize, split_args, is_blank, LINE_SECTION,
+                                       LINE_KEY, LINE_BAD)
+
+MAGIC = 'BINI'
+VERSION = 1
+
+TYPE_INT = 1
+TYPE_FLOAT = 2
+TYPE_STRING = 3
+
+_HEADER = struct.Struct('<4sII')
+_SECTION = struct.Struct('<HH')
+_ENTRY = struct.Struct('<HB')
+_VALUE = {TYPE_INT: struct.Struct('<Bi'),
+          TYPE_FLOAT: struct.Struct('<Bf'),
+          TYPE_STRING: struct.Struct('<Bi')}
+_VALUE_SIZE = 5
+
+_INT_RE = re.compile(r'^-?\d+$')
+_FLOAT_RE = re.compile(r'^-?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$')
+
+
+class BiniError(Exception):
+    """BiniError
+    Raised when BINI data is invalid, or lines can not be encoded.
+    """
+    pass
+
+
+def is_bini(data):
+    """is_bini(data)
+    Returns True if the data starts with the BINI magic.
+    """
+    return data[:4] == MAGIC
+
+
+def format_float(value):
+    """format_float(value)
+    Returns the shortest string for a float32 value that reads back as the
+    same value, always including a decimal point so its encoded as a float.
+    """
+    packed = struct.pack('<f', value)
+    for precision in (6, 7, 8, 9):
+        string = '%.*g' % (precision, value)
+        if struct.pack('<f', float(string)) == packed:
+            break
+    if '.' not in string and 'e' not in string and 'n' not in string: # inf, nan
+        string += '.0'
+    return string
+
+
+def iter_lines(data):
+    """iter_lines(data)
+    Decodes BINI data, yielding text ini lines: a '[Section]' line for each
+    section followed by its 'key = value, value' lines and a blank line.
+    Entries without values are 'key =' lines.
+    The data is read with struct through a memoryview without copying it,
+    only the used strings are copied out of the string table.
+    """
+    view = memoryview(data)
+    try:
+        magic, version, table = _HEADER.unpack_from(view, 0)
+    except struct.error:
+        raise BiniError("Truncated BINI header")
+    if magic != MAGIC:
+        raise BiniError("Not a BINI file")
+    if version != VERSION:
+        raise BiniError("Unsupported BINI version %s" % version)
+    if table > len(data):
+        raise BiniError("String table offset past the end of file")
+
+    strings = {}
+    def string(offset):
+        try:
+            return strings[offset]
+        except KeyError:
+            pass
+        start = table + offset
+        end = data.find('\0', start)
+        if end == -1 or start > len(data):
+            raise BiniError("Bad string offset %s" % offset)
+        strings[offset] = value = data[start:end]
+        return value
+
+    pos = _HEADER.size
+    try:
+        while pos < table:
+            name, count = _SECTION.unpack_from(view, pos)
+            pos += _SECTION.size
+            yield '[%s]' % string(name)
+            for _ in xrange(count):
+                name, values = _ENTRY.unpack_from(view, pos)
+                pos += _ENTRY.size
+                args = []
+                for _ in xrange(values):
+                    vtype = ord(data[pos])
+                    try:
+                        value = _VALUE[vtype].unpack_from(view, pos)[1]
+                    except KeyError:
+                        raise BiniError("Unknown value type %s at offset %s" %
+                                        (vtype, pos))
+                    pos += _VALUE_SIZE
+                    if vtype == TYPE_INT:
+                        args.append(str(value))
+                    elif vtype == TYPE_FLOAT:
+                        args.append(format_float(value))
+                    else:
+                        args.append(string(value))
+                if args:
+                    yield '%s = %s' % (string(name), ', '.join(args))
+                else:
+                    yield '%s =' % string(name)
+            yield ''
+    except (struct.error, IndexError):
+        raise BiniError("Truncated BINI data at offset %s" % pos)
+
+
+def decode(data):
+    """decode(data)
+    Decodes BINI data, returning a list of text ini lines. See iter_lines()
+    """
+    return list(iter_lines(data))
+
+
+def _value(arg):
+    """_value(arg)
+    Internal function. Returns the (type, value) of a text ini argument.
+    """
+    if _INT_RE.match(arg):
+        value = int(arg)
+        if -0x80000000 <= value <= 0x7FFFFFFF:
+            return TYPE_INT, value
+    if _FLOAT_RE.match(arg):
+        return TYPE_FLOAT, float(arg)
+    return TYPE_STRING, arg
+
+
+def encode(lines):
+    """encode(lines)
+    Encodes a list of text ini lines (such as IniSection.lines) into BINI data.
+    Comments and blank lines are dropped, lines before the first [Section] are
+    ignored. Integer and float arguments are stored as numbers, anything else
+    as strings. 'key =' lines and lines with only a key are entries without
+    values.
+    """
+    sections = [] # [(name, [(key, [(type, value), ...]), ...]), ...]
+    for line in lines:
+        ltype, key, value, _ = tokenize(line)
+        if ltype == LINE_SECTION:
+            sections.append((key, []))
+        elif not sections:
+            continue
+        elif ltype == LINE_KEY:
+            args = [_value(arg) for arg in split_args(value)]
+            sections[-1][1].append((key.strip(), args))
+        elif ltype == LINE_BAD:
+            key, equals, rest = line.partition('=')
+            if not equals:
+                sections[-1][1].append((line.strip(), [])) # key without a value
+            elif key.strip() and ';' not in key and is_blank(rest):
+                sections[-1][1].append((key.strip(), [])) # 'key =' without a value
+
+    # names use 16 bit offsets, so they go at the start of the string table
+    table = []
+    offsets = {}
+    size = [0]
+    def add_string(string):
+        if string not in offsets:
+            offsets[string] = size[0]
+            size[0] += len(string) + 1
+            table.append(string)
+        return offsets[string]
+
+    for name, entries in sections:
+        add_string(name)
+        for key, _ in entries:
+            add_string(key)
+    if table and offsets[table[-1]] > 0xFFFF:
+        raise BiniError("Too many section and key names to encode")
+
+    body = []
+    for name, entries in sections:
+        if len(entries) > 0xFFFF:
+            raise BiniError("Too many entries in [%s]" % name)
+        body.append(_SECTION.pack(offsets[name], len(entries)))
+        for key, values in entries:
+            if len(values) > 0xFF:
+                raise BiniError("Too many values for '%s' in [%s]" % (key, name))
+            body.append(_ENTRY.pack(offsets[key], len(values)))
+            for vtype, value in values:
+                if vtype == TYPE_STRING:
+                    value = add_string(value)
+                body.append(_VALUE[vtype].pack(vtype, value))
+
+    body = ''.join(body)
+    header = _HEADER.pack(MAGIC, VERSION, _HEADER.size + len(body))
+    strings = ''.join(['%s\0' % string for string in table])
+    return header + body + strings
@@ -35,13 +35,19 @@ r"""
 
 
 """
+import os
+import copy_reg
 from os.path import join, exists
 
 from freelancer.core import log, parser
 from freelancer.core import data as fldata
 from freelancer.core.data import (stats_inc, STATS_LINES, STATS_FILES,
                                   STATS_SECTIONS, STATS_KEYS, STATS_ERRORS)
-from freelancer.core.regex import SECTION_RE, LINE_COMMENT_RE, LINE_SPLIT_RE
+from freelancer.core.tokenizer import section_name, is_blank, split_line, split_args
+from freelancer.core.diagnostics import (report, UNKNOWN_SECTION, BAD_LINE, UNKNOWN_KEY,
+                                         NOT_MULTILINE, MISSING_REQUIRED_KEY,
+                                         MISSING_SORT_KEY, DUPLICATE_LOCAL_UNIQUE)
+from freelancer.files import bini, map_lines
 
 s_general = None
 
@@ -49,17 +55,20 @@ s_general = None
 FLAG_LOG = 1
 FLAG_STAT = 2
 FLAG_FLDATA = 4
+FLAG_LAZY = 8
+FLAG_MMAP = 16
+
+# dtypes IniSection.get() caches converted values for
+_CACHED_DTYPES = (bool, int, float, str)
 
 
 def splitline(line):
     """splitline(line)
-    Splits a string by commas and returns the list (or None). Note this uses a
-    precompiled regex and does a better job then .split(',')
+    Splits a 'key = value ; comment' line and returns a (key, value, comment)
+    tuple (or None). Note this uses freelancer.core.tokenizer and does a better
+    job then .split('=')
     """
-    try:
-        return LINE_SPLIT_RE.match(line).groups()
-    except AttributeError:
-        return None
+    return split_line(line)
 
 
 def buildline(line):
@@ -81,6 +90,16 @@ class FileReadError(Exception):
         log.error("File Read: %s --- %s" % (message, path))
 
 
+def _offset_lines(data):
+    """_offset_lines(data)
+    Internal function. Yields a (byte offset, line) tuple for each line in data
+    """
+    pos = 0
+    for line in data.splitlines(True):
+        yield pos, line
+        pos += len(line)
+
+
 class IniFile(list):
     r"""IniFile(filename, directory=None, group=None, flags=0))
     Reads and parses a ini file. a IniFile object acts as a list,
@@ -91,7 +110,15 @@ class IniFile(list):
     directory = prepended to 'filename' when opening files. When dealing with
         FL data files this usually points to the Freelancer\Data directory
     group = a parser rule group to use when parsing.
-    flags = bitwise combo of FLAG_LOG, FLAG_STAT, FLAG_FLDATA
+    flags = bitwise combo of FLAG_LOG, FLAG_STAT, FLAG_FLDATA, FLAG_LAZY,
+        FLAG_MMAP
+
+    When FLAG_MMAP is set, the file is read through mmap one line at a time,
+    instead of reading the whole file into memory and splitting it.
+
+    When FLAG_LAZY is set, sections are created as LazyIniSection objects that
+    only register their sort key when the file is read. The rest of the lines
+    are parsed and validated the first time any key in the section is accessed.
 
     IniFile objects function as lists, so ini [Sections] can be accessed by
     index, iterated through, or resorted.
@@ -100,15 +127,25 @@ class IniFile(list):
     zones = [z for z in systems.get_system('li01') if z.section == 'zone']
 
     Each [Section] in the ini file is created as a IniSection object.
+
+    BINI compressed files are decoded and parsed the same as text files, and
+    are written back as BINI. Setting .bini to True before writing saves a
+    text file as BINI. Comments and blank lines are not kept in BINI files.
     """
     fullpath = None # full path (or relative to our working PyFL directory)
     changed = False # True if file has changed and needs update()
+    streamed = False # sections are from iter_sections()
     group = None # file type group...goods equipmemnt, etc
     keymap = None
     path = None
 
     _head = None # top lines above [any sections]
     _data = None # list of all raw unparsed lines in file
+    _index = None # _index[section name] = [IniSection, ...] in file order
+    _newline = '\n' # line endings used in the file
+    _headsize = 0 # size in bytes of the top lines in the file
+    _source = None # (mtime, size) of the file when last read or written
+    bini = False # read from a BINI file, and written back as one
 
     def __init__(self, filename, directory=None, group=None, flags=0):
         list.__init__(self)
@@ -148,59 +185,81 @@ class IniFile(list):
         if not exists(self.fullpath):
             raise FileReadError("Missing File", self.path)
 
-        fih = open(self.fullpath)
-        lines = fih.read()
-        fih.close()
-        if lines[0:4] == 'BINI':
-            raise FileReadError("BINI File file detected, refusing to read." +
-                                " This may generate additional warnings later",
-                                self.fullpath)
-        lines = lines.splitlines()
-
-
-        last = [] # lines of the last section
-        section = None
-        index = 0
+        self._source = self._get_source()
+        size, source = self._read_lines()
 
-        _data = []
-        for i, line in enumerate(lines):
+        # all the lines are kept in one shared buffer, sections only store their
+        # start and end offsets into it
+        self._data = lines = []
+        headers = [] # (section, line index, byte offset) of each [section]
+        for i, (pos, line) in enumerate(source):
             line = line.rstrip()
-            if self.flags&FLAG_STAT:
-                stats_inc(STATS_LINES)
-
-            match = SECTION_RE.match(line) # check for new [section]
-            if match and not section is None:
-                # found first section in the file
-                _data.append((section, last, index))
-
-            if match:
-                # set tracking variables
-                index = 1 + i
-                section = match.group(1).lower()
-                last = [line]
-                continue
-
-            if section is None:
-                # got lines but no section, probably file header comments
-                self._head.append(line)
-            else:
-                last.append(line)
-
-        if section: # append last section in file
-            _data.append((section, last, index))
-
-        for section, lines, index in _data:
-            self.append(IniSection(section, lines, index, self))
+            lines.append(line)
+            name = section_name(line) # check for new [section]
+            if name is not None:
+                headers.append((name.lower(), i, pos))
+        if self.flags&FLAG_STAT:
+            stats_inc(STATS_LINES, len(lines))
+
+        if headers:
+            # got lines but no section, probably file header comments
+            self._head = lines[:headers[0][1]]
+            self._headsize = headers[0][2]
+        else:
+            self._head = lines[:]
+            self._headsize = size
+        headers.append((None, len(lines), size))
+
+        section_class = IniSection
+        if self.flags&FLAG_LAZY:
+            section_class = LazyIniSection
+        for i, (section, start, offset) in enumerate(headers[:-1]):
+            end, endpos = headers[i+1][1:]
+            obj = section_class(section, None, start + 1, self, span=(start, end))
+            obj._range = (offset, endpos)
+            self.append(obj)
+
+
+    def _read_lines(self):
+        """IniFile._read_lines()
+        Internal function. Returns the size of the file and a iterator of
+        (byte offset, line) for each line in it. With FLAG_MMAP the lines are
+        read through a mmap of the file, instead of reading the whole file.
+        BINI files are decoded.
+        """
+        fih = open(self.fullpath, 'rb')
+        try:
+            if self.flags&FLAG_MMAP and not bini.is_bini(fih.read(4)):
+                fih.seek(0)
+                if fih.readline()[-2:] == '\r\n':
+                    self._newline = '\r\n'
+                return self._source[1], map_lines(self.fullpath)
+            fih.seek(0)
+            data = fih.read()
+        finally:
+            fih.close()
+
+        if bini.is_bini(data):
+            # decoded to text lines. theres no original text to splice changes
+            # into, so updates rewrite the whole file.
+            try:
+                data = '\n'.join(bini.decode(data))
+            except bini.BiniError as msg:
+                raise FileReadError("Bad BINI File (%s)" % msg, self.fullpath)
+            self.bini = True
+            self._source = None
+        elif '\r\n' in data:
+            self._newline = '\r\n'
+        return len(data), _offset_lines(data)
 
 
     def find(self, section, index=0):
         """IniFile.find(section)
         Finds and returns the first IniSection() object of the specified type.
         """
-        section = section.lower()
-        results = [x for x in self if x.section == section]
+        results = self._get_index().get(section.lower(), [])
         if index is None:
-            return results
+            return results[:]
         try:
             return results[index]
         except IndexError:
@@ -228,6 +287,8 @@ class IniFile(list):
 
         Unsorted sections are appended to the bottom.
         Note IniFile.update() must be called to save the changes.
+        This calls cmp_func for every item and section, resort_by() is much
+        faster for large files.
 
         example: resort based on a list of section names
         .resort(section_list, lambda item, obj: obj.section == item)
@@ -252,45 +313,143 @@ class IniFile(list):
         self.changed = True
 
 
-#==============================================================================
-#
-#     def resortBySectionKey(self, section, key, sort_list):
-#         """IniFile.resortBySectionKey(key, section, key, sort_list)
-#         Resorts the IniSection() objects based on the given key, but only for the
-#         specified section, keeping order of trailing sections. Ideal for sorting
-#         things like mbases.ini where trailing sections matter.
-#         """
-#         done = []
-#         keep = False
-#         for sort_item in sort_list:
-#             popped = []
-#             for index, current_section in enumerate(self):
-#
-#                 if current_section.section == section: # right type
-#                     keep = False
-#                 elif keep: # keep is true, so keep order here
-#                     popped.append(index)
-#                     done.append(current_section)
-#                     continue
-#                 else:
-#                     continue
-#
-#                 val = current_section.get(key)
-#                 if not val or val.lower() != sort_item.lower():
-#                     continue
-#                 keep = True # everything matches, set keep
-#
-#                 popped.append(index)
-#                 done.append(current_section)
-#
-#             count = 0
-#             for index in popped:
-#                 self.pop(index-count)
-#                 count += 1
-#         self[0:] = done + self
-#         self.changed = True
-#
-#==============================================================================
+    def resort_by(self, key_func, order, section=None):
+        """IniFile.resort_by(key_func, order, section=None)
+        Resorts the IniSection() objects so key_func(section) follows the order
+        of the values in the order list. This uses a single stable sort, so
+        sections with the same key keep their current order. Sections whose key
+        is not in order are kept at the bottom, in their current order.
+        Keys are compared as is, key_func should lowercase them if needed.
+
+        If section is given, only sections of that type are sorted by key, and
+        any trailing sections up to the next one of that type are moved with it.
+        Ideal for sorting things like mbases.ini where trailing sections matter.
+        Any sections before the first one of that type are left at the top.
+        Note IniFile.update() must be called to save the changes.
+
+        example: resort based on list of nicknames
+        .resort_by(lambda obj: obj.get('nickname', '').lower(), name_list)
+
+        example: resort mbases.ini by base nickname
+        .resort_by(lambda obj: obj['nickname'].lower(), base_list, 'mbase')
+        """
+        rank = {}
+        for index, item in enumerate(order):
+            rank.setdefault(item, index)
+        unsorted = len(order)
+
+        if section is not None:
+            section = section.lower()
+        top = [] # sections before the first section to sort
+        groups = []
+        for obj in self:
+            if section is None or obj.section == section:
+                groups.append([obj])
+            elif groups:
+                groups[-1].append(obj)
+            else:
+                top.append(obj)
+
+        groups.sort(key=lambda group: rank.get(key_func(group[0]), unsorted))
+        self[0:] = top + [obj for group in groups for obj in group]
+        self.changed = True
+
+
+    def parse_lazy(self):
+        """IniFile.parse_lazy()
+        Parses the sections of a FLAG_LAZY file that havent been parsed yet, so
+        their lines are validated and cross references queued. Returns the
+        number of sections parsed. Batched numeric checks are left for
+        parser.flush_checks()
+        """
+        count = 0
+        if not self.flags&FLAG_LAZY:
+            return count
+        for obj in self:
+            if not obj._parsed:
+                obj._parsed = True
+                IniSection.parse(obj)
+                count += 1
+        return count
+
+
+    def _get_index(self):
+        """IniFile._get_index()
+        Internal function. Returns the section name index used by find(),
+        rebuilding it if the list of sections has been changed.
+        """
+        if self._index is None:
+            index = {}
+            for obj in self:
+                index.setdefault(obj.section, []).append(obj)
+            self._index = index
+        return self._index
+
+
+    def append(self, obj):
+        list.append(self, obj)
+        if self._index is not None:
+            self._index.setdefault(obj.section, []).append(obj)
+
+    def extend(self, objs):
+        objs = list(objs)
+        list.extend(self, objs)
+        if self._index is not None:
+            for obj in objs:
+                self._index.setdefault(obj.section, []).append(obj)
+
+    # any other change in the order of sections drops the index, its rebuilt
+    # the next time find() is called.
+    def insert(self, index, obj):
+        self._index = None
+        list.insert(self, index, obj)
+
+    def remove(self, obj):
+        self._index = None
+        list.remove(self, obj)
+
+    def pop(self, *args):
+        self._index = None
+        return list.pop(self, *args)
+
+    def sort(self, *args, **kwargs):
+        self._index = None
+        list.sort(self, *args, **kwargs)
+
+    def reverse(self):
+        self._index = None
+        list.reverse(self)
+
+    def __setitem__(self, index, obj):
+        self._index = None
+        list.__setitem__(self, index, obj)
+
+    def __delitem__(self, index):
+        self._index = None
+        list.__delitem__(self, index)
+
+    def __setslice__(self, i, j, objs):
+        self._index = None
+        list.__setslice__(self, i, j, objs)
+
+    def __delslice__(self, i, j):
+        self._index = None
+        list.__delslice__(self, i, j)
+
+    def __iadd__(self, objs):
+        self.extend(objs)
+        return self
+
+    def __imul__(self, count):
+        self._index = None
+        return list.__imul__(self, count)
+
+
+    def __getstate__(self):
+        # the index is rebuilt when needed, dont store it
+        state = self.__dict__.copy()
+        state.pop('_index', None)
+        return state
 
 
     def backup(self):
@@ -305,34 +464,126 @@ class IniFile(list):
         """IniFile.write(backup=True)
         Writes the data in memory to the file, optionally creating a backup first.
         """
-        if backup:
-            self.backup()
-
-        fih = open(self.fullpath, 'w')
-        if self._head:
-            fih.write("%s\n" % '\n'.join(self._head))
-        for obj in self:
-            string = '\n'.join(obj.lines)
-            end = '\n'
-            if string[-2:] == '\n\n':
-                end = ''
-            fih.write("%s%s" % (string, end))
-        fih.close()
+        self._write(backup)
 
 
     def update(self, backup=True):
         """IniFile.update(backup=True)
         Writes the data in memory to the file if it has changed, optionally creating
-        a backup first.
+        a backup first. Only the changed sections are rebuilt, the rest are copied
+        as is from the original file, unless the file was modified since it was
+        read.
         """
         if not self.changed:
             return False
-        self.write(backup)
+        self._write(backup, splice=True)
         self.changed = False
         for obj in self:
             obj.changed = False
 
 
+    def _get_source(self):
+        """IniFile._get_source()
+        Internal function. Returns the (mtime, size) of the file on disk, or None.
+        """
+        try:
+            stat = os.stat(self.fullpath)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size)
+
+
+    def _render(self, lines):
+        """IniFile._render(lines)
+        Internal function. Returns the text to write for a list of lines.
+        """
+        newline = self._newline
+        string = newline.join(lines)
+        if string[-2*len(newline):] == newline * 2:
+            return string
+        return string + newline
+
+
+    def _write(self, backup=True, splice=False):
+        """IniFile._write(backup=True, splice=False)
+        Internal function. Writes the file through a temp file that replaces the
+        original. If splice is True, unchanged sections are copied from their
+        byte range in the original file instead of being rebuilt.
+        """
+        source = None
+        if splice and self._source and self._source == self._get_source():
+            fih = open(self.fullpath, 'rb')
+            source = fih.read()
+            fih.close()
+
+        temp = '%s.tmp' % self.fullpath
+        fih = open(temp, 'wb')
+        try:
+            if self.bini:
+                lines = list(self._head)
+                for obj in self:
+                    lines.extend(obj.lines)
+                fih.write(bini.encode(lines))
+            else:
+                self._write_text(fih, source)
+        finally:
+            fih.close()
+
+        if backup:
+            self._replace_backup()
+        try:
+            os.rename(temp, self.fullpath)
+        except OSError: # windows wont rename over a existing file
+            os.remove(self.fullpath)
+            os.rename(temp, self.fullpath)
+        self._source = None
+        if not self.bini:
+            self._source = self._get_source()
+
+
+    def _write_text(self, fih, source=None):
+        """IniFile._write_text(fih, source=None)
+        Internal function. Writes the sections as text to the open file. If
+        source is the original file's data, unchanged sections are copied from it.
+        """
+        if source is not None:
+            head = source[:self._headsize]
+        elif self._head:
+            head = self._newline.join(self._head) + self._newline
+        else:
+            head = ''
+        fih.write(head)
+        pos = self._headsize = len(head)
+
+        for obj in self:
+            ours = obj.file is self
+            if (source is not None and ours and obj._range and not obj.changed
+                    and obj._lines is None):
+                string = source[obj._range[0]:obj._range[1]]
+                if string[-1:] != '\n':
+                    string += self._newline # was the last line of the file
+            else:
+                string = self._render(obj.lines)
+            fih.write(string)
+            if ours:
+                obj._range = (pos, pos + len(string))
+            pos += len(string)
+
+
+    def _replace_backup(self):
+        """IniFile._replace_backup()
+        Internal function. Keeps the current file as the .bak backup before it
+        is replaced, linking it instead of copying where possible.
+        """
+        backup = "%s.bak" % self.fullpath
+        if exists(backup):
+            os.remove(backup)
+        try:
+            os.link(self.fullpath, backup)
+        except (AttributeError, OSError):
+            self.backup()
+
+
     def __repr__(self):
         return "%s (%s sections)" % (self.path, len(self))
 
@@ -354,44 +605,112 @@ class IniFile(list):
 #==============================================================================
 
 class IniSection(dict):
-    """IniSection(self, section, lines=None, index=None, parent=None)
+    """IniSection(self, section, lines=None, index=None, parent=None, parse=True, span=None)
     Object representing a [Section] in a ini file. It is not required to manually
     create these in your code, they are automatically generated when parsing a ini
-    file.
+    file. If parse is False, parse() must be called manually.
+
+    Sections read from a file dont keep their own copy of the raw lines, span is
+    the (start, end) offsets of the section in the parent IniFile's shared line
+    buffer. The lines are only copied into the section when it is edited.
+    Note IniSection.lines is a tuple for unedited sections, to change the lines
+    assign a new list to IniSection.lines (or use set() and edit_key())
 
     IniSection objects function as dicts:
     zone_names = [z['nickname'] for z in zones]
 
     """
-    section = None # name of section
-    lines = None # raw data
-    index = None # line index for start of section in ini
-    file = None # ini file
-    changed = False # content has changed
-    keyorder = None
-    rules = None
-    group = None
-
-    def __init__(self, section, lines=None, index=None, parent=None):
+    __slots__ = ('section', # name of section
+                 'index', # line index for start of section in ini
+                 'file', # ini file
+                 'changed', # content has changed
+                 'rules',
+                 'group',
+                 '_start', # offsets in the ini file's line buffer
+                 '_end',
+                 '_lines', # raw data, only set once edited
+                 '_range', # (start, end) byte offsets in the file
+                 '_keylines', # _keylines[key] = [line index, ...], built on edit
+                 '_typed', # _typed[(key, dtype)] = value cache for get()
+                )
+
+    def __init__(self, section, lines=None, index=None, parent=None, parse=True,
+                 span=None):
         dict.__init__(self)
 
-        if lines is None:
+        if span is None and lines is None:
             lines = []
         self.section = section
-        self.lines = lines
+        self._lines = lines
+        self._start, self._end = span or (None, None)
+        self._range = None
+        self._keylines = None
+        self._typed = None
         self.index = index
         self.file = parent
         self.group = parent.group
-        self.keyorder = []
+        self.changed = False
+        self.rules = None
 
         self._stat(STATS_SECTIONS) # increment stats
-        self.parse()
+        if parse:
+            self.parse()
+
+
+    def _getlines(self, offset=0):
+        """IniSection._getlines(offset=0)
+        Internal function. Returns the raw lines of the section starting at offset,
+        without copying them into the section.
+        """
+        if self._lines is not None:
+            return self._lines[offset:]
+        return self.file._data[self._start+offset:self._end]
+
+
+    def _get_lines(self):
+        if self._lines is not None:
+            return self._lines
+        # a tuple, so changes that wouldnt be kept raise a error instead
+        return tuple(self._getlines())
+
+    def _set_lines(self, lines):
+        self._lines = list(lines)
+        self._keylines = None
+
+    lines = property(_get_lines, _set_lines, doc="raw lines of the section")
+
+
+    @property
+    def keyorder(self):
+        """order of the keys in the section"""
+        keys = []
+        for line in self._getlines(1):
+            if is_blank(line):
+                continue
+            split = split_line(line)
+            if split is not None:
+                keys.append(split[0].lower())
+        return keys
+
 
     def parse(self):
         """IniSection.parse()
         Parses the data for the section. This is normally automatically called
         when the section is generated (ie: the file has been read)
         """
+        # files queued while parsing are recorded as dependencies of this file
+        previous = fldata._PARSING
+        fldata._PARSING = self.file.path.lower()
+        try:
+            self._parse()
+        finally:
+            fldata._PARSING = previous
+
+
+    def _parse(self):
+        """IniSection._parse()
+        Internal method. Does the parsing for parse()
+        """
         rules = None
         required = []
 
@@ -402,30 +721,28 @@ class IniSection(dict):
                 required = rules.required
             except KeyError:
                 self._stat(STATS_ERRORS) # increment stats
-                self._warn("FLData: (%s:%s) Unknown section in file %s (line %s)" %
-                           (self.group, self.section, self.file.path, self.index))
+                self._report(UNKNOWN_SECTION, self.index, self.group, self.section)
         self.rules = rules
         # parse each line
-        for i, line in enumerate(self.lines[1:]):
+        for i, line in enumerate(self._getlines(1)):
             i = 1+ i
-            if not LINE_COMMENT_RE.sub('', line):
+            if is_blank(line):
                 continue # blank line
 
-            match = LINE_SPLIT_RE.match(line)
-            if not match:
+            split = split_line(line)
+            if split is None:
                 self._stat(STATS_ERRORS) # increment stats
-                self._warn("FLData: Bad line in file %s (line %s)" %
-                           (self.file.path, i + self.index))
+                self._report(BAD_LINE, i + self.index)
                 continue
 
-            key = match.group(1).lower()
-            val = match.group(2)
-            self.keyorder.append(key)
+            key = split[0].lower()
+            val = split[1]
             self._stat(STATS_KEYS) # increment stats
             self._setkey(i, key, val)
 
-        # check for a sortkey 'ie: nickname ='
-        if rules and rules.sortkey:
+        # check for a sortkey 'ie: nickname ='. these are only tracked for FL
+        # data files
+        if rules and rules.sortkey and self.file.flags&FLAG_FLDATA:
             self._add_unique_key()
 
         if not required:
@@ -435,8 +752,7 @@ class IniSection(dict):
         for req in required:
             if self.get(req, None) is None:
                 self._stat(STATS_ERRORS) # increment stats
-                self._warn("FLData: (%s:%s) Missing Required key '%s' in file %s (line %s)" %
-                           (self.group, self.section, req, self.file.path, self.index))
+                self._report(MISSING_REQUIRED_KEY, self.index, self.group, self.section, req)
 
 
     def get(self, key, default=None, dtype=None):
@@ -461,19 +777,68 @@ class IniSection(dict):
 
         # returns a proper True/False
         section.get('bool_key', default=False, dtype=bool)
+
+        Values converted to bool, int, float or str are cached per key and dtype
+        until the section is changed.
         """
         value = dict.get(self, key, default)
-        if dtype is bool:
-            if value.upper() in ('TRUE', '1', 'YES', 'ON'):
-                value = True
-            elif value.upper() in ('FALSE', '0', 'NO', 'OFF'):
-                value = False
-        try:
-            return dtype(value)
-        except TypeError:
-            return value
-        except ValueError:
+        if dtype is None:
             return value
+        # converted values are cached until the section is changed
+        cache = dtype in _CACHED_DTYPES
+        typed = self._typed
+        if cache and typed is not None and (key, dtype) in typed:
+            return typed[(key, dtype)]
+
+        result = value
+        if dtype is bool and isinstance(value, str):
+            upper = value.upper()
+            if upper in ('TRUE', '1', 'YES', 'ON'):
+                result = True
+            elif upper in ('FALSE', '0', 'NO', 'OFF'):
+                result = False
+        try:
+            result = dtype(result)
+        except (TypeError, ValueError):
+            pass
+        if cache and dict.__contains__(self, key):
+            if typed is None:
+                typed = self._typed = {}
+            typed[(key, dtype)] = result
+        return result
+
+
+    def get_args(self, key, default=None):
+        """IniSection.get_args(self, key, default=None)
+        Returns the value of the key as a tuple of its comma separated arguments,
+        converted to int, float or bool based on the parser rules for the key.
+        Multiline keys return a tuple of tuples. Without rules for the key all
+        the arguments are strings. If the key is not found returns default.
+        Like get(dtype=...) the results are cached until the section is changed.
+
+        x, y, z = zone.get_args('pos')
+        for rep, faction in group.get_args('rep'):
+        """
+        typed = self._typed
+        if typed is not None and (key, 'args') in typed:
+            return typed[(key, 'args')]
+        value = self.get(key)
+        if value is None:
+            return default
+
+        rule = self.rules and self.rules.get(key)
+        if rule is not None:
+            convert = rule.convert
+        else:
+            convert = lambda value: tuple(split_args(value))
+        if isinstance(value, list):
+            result = tuple([convert(val) for val in value])
+        else:
+            result = convert(value)
+        if typed is None:
+            typed = self._typed = {}
+        typed[(key, 'args')] = result
+        return result
 
 
     def set(self, key, value):
@@ -485,25 +850,89 @@ class IniSection(dict):
 
         self.edit_key(key, value)
 
+    # any change to the keys clears the get() cache
+    def __setitem__(self, key, value):
+        self._typed = None
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._typed = None
+        dict.__delitem__(self, key)
+
+    def pop(self, key, *args):
+        self._typed = None
+        return dict.pop(self, key, *args)
+
+    def update(self, *args, **kwargs):
+        self._typed = None
+        dict.update(self, *args, **kwargs)
+
+    def clear(self):
+        self._typed = None
+        dict.clear(self)
+
+    def popitem(self):
+        self._typed = None
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        self._typed = None
+        return dict.setdefault(self, key, default)
+
+
     def edit_key(self, key, value):
         """IniSection.edit_key(self, key, value)
+        Changes the raw lines of the key to the new value. If value is a list
+        (multiline keys) lines are added after the last existing line of the key,
+        or removed from the end, when the number of values changes. Comments on
+        the existing lines are kept.
         """
-        items = []
-        for i, line in enumerate(self.lines):
-            split = splitline(line)
-            if split and split[0].lower() == key:
-                items.append((i, list(split)))
-
+        key = key.lower()
         if isinstance(value, (str, int, float)):
             value = [value]
+        lines = self._edit_lines()
+        positions = self._keylines.get(key, [])
 
-        if len(items) != len(value):
-            raise NotImplementedError
-
-        for index, val in enumerate(value):
-            line_index, line = items[index]
+        for line_index, val in zip(positions, value):
+            line = list(splitline(lines[line_index]))
             line[1] = val
-            self.lines[line_index] = buildline(line)
+            lines[line_index] = buildline(line)
+
+        if len(positions) == len(value):
+            return
+        if len(value) > len(positions):
+            if positions:
+                name = splitline(lines[positions[-1]])[0]
+                at = positions[-1] + 1
+            else:
+                # new key, add it after the last 'key = value' line
+                name = key
+                used = [i for keylines in self._keylines.values() for i in keylines]
+                at = 1 + max(used or [0])
+            lines[at:at] = [buildline((name, val)) for val in value[len(positions):]]
+        else:
+            for line_index in reversed(positions[len(value):]):
+                del lines[line_index]
+        self._keylines = None # line numbers moved, rebuilt on the next edit
+
+
+    def _edit_lines(self):
+        """IniSection._edit_lines()
+        Internal function. Copies the raw lines into the section so they can be
+        edited, and builds the key -> [line index] map used by edit_key().
+        """
+        if self._lines is None:
+            self._lines = self._getlines()
+        if self._keylines is None:
+            keylines = {}
+            for i, line in enumerate(self._lines):
+                if i == 0 or is_blank(line):
+                    continue
+                split = split_line(line)
+                if split is not None:
+                    keylines.setdefault(split[0].lower(), []).append(i)
+            self._keylines = keylines
+        return self._lines
 
 
     def _setkey(self, index, key, value):
@@ -511,6 +940,7 @@ class IniSection(dict):
         Internal Function. This sets the key in the IniSection dict to the
         value, and validates the value with the rules.
         """
+        self._typed = None # multiline values are appended in place
         # no rules to follow, just do it
         if self.rules is None:
             if not self.get(key, None):
@@ -525,19 +955,24 @@ class IniSection(dict):
         rule = self.rules.get(key.lower())
         if rule is None:
             stats_inc(STATS_ERRORS) # increment stats
-            log.warn("FLData: (%s:%s) Unknown key '%s = %s' in file %s (line %s)" %
-                     (self.group, self.section, key, value, self.file.path, self.index + index))
+            report(UNKNOWN_KEY, self.file.path, self.index + index,
+                   self.group, self.section, key, value)
             return
 
         elif self.has_key(key) and not rule.multiline:
             stats_inc(STATS_ERRORS) # increment stats
-            log.warn("FLData: (%s:%s) Key '%s' is not multiline in file %s (line %s)" %
-                     (self.group, self.section, key, self.file.path, self.index + index))
+            report(NOT_MULTILINE, self.file.path, self.index + index,
+                   self.group, self.section, key)
             return
 
-        if s_general.get('validate_data', dtype=bool):
-            match_check = s_general.get('match_checks', dtype=bool)
-            rule.check(self, index, key, value, match_check=match_check)
+        # without settings (freelancer.core.init() wasnt called) lines arent validated
+        if s_general is not None and s_general.get('validate_data', dtype=bool):
+            if self.file.streamed:
+                # streamed sections arent kept, so nothing can be queued for later
+                parser.check_unqueued(rule, self, index, key, value)
+            else:
+                match_check = s_general.get('match_checks', dtype=bool)
+                rule.check(self, index, key, value, match_check=match_check)
 
         if rule.multiline:
             self[key] = self.get(key, [])
@@ -546,18 +981,19 @@ class IniSection(dict):
             self[key] = value
 
 
-    def _add_unique_key(self):
-        """IniSection._add_unique_key()
-        Internal function. Adds the key to the core.data handlers.
+    def _add_unique_key(self, value=None):
+        """IniSection._add_unique_key(value=None)
+        Internal function. Adds the key to the core.data handlers. If value is
+        None, the value of the sort key is used.
         """
         key = self.rules.sortkey
         key = key.lower()
         try:
-            value = self[key]
+            if value is None:
+                value = self[key]
         except KeyError:
             self._stat(STATS_ERRORS) # increment stats
-            self._warn("FLData: (%s:%s) Missing required sort key '%s' in file %s (line %s)" %
-                       (self.group, self.section, key, self.file.path, self.index))
+            self._report(MISSING_SORT_KEY, self.index, self.group, self.section, key)
             return
         from freelancer.core.parser import GLOBAL_UNIQUE, GROUP_UNIQUE, SECTION_UNIQUE, \
                 LOCAL_UNIQUE
@@ -590,8 +1026,7 @@ class IniSection(dict):
             keymap = self.file.keymap
             if keymap.get(value):
                 self._stat(STATS_ERRORS) # increment stats
-                self._warn("FLData: Duplicate Local Unique '%s' in file %s (line %s)" %
-                           (value, self.file.path, self.index))
+                self._report(DUPLICATE_LOCAL_UNIQUE, self.index, value)
             else:
                 keymap[value] = self
         else:
@@ -608,7 +1043,289 @@ class IniSection(dict):
         if self.file.flags&FLAG_LOG:
             log.warn(message)
 
+    def _report(self, code, line, *args):
+        if self.file.flags&FLAG_LOG:
+            report(code, self.file.path, line, *args)
+
+
+    def __getstate__(self):
+        state = {}
+        for cls in self.__class__.__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                state[name] = getattr(self, name)
+        # rules are shared parser objects, store their name instead of copies
+        if self.rules is not None:
+            state['rules'] = (self.rules.group, self.rules.section)
+        return state
+
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        if self.rules is not None:
+            self.rules = parser.get_rules(*self.rules)
+
 
     def __repr__(self):
         return '%s' % self.section
 
+
+
+#==============================================================================
+#
+#==============================================================================
+
+class LazyIniSection(IniSection):
+    """LazyIniSection(self, section, lines=None, index=None, parent=None, span=None)
+    A IniSection that is parsed the first time any of its keys are accessed,
+    created by IniFile when FLAG_LAZY is set. Only the sort key (nickname etc)
+    is read right away, so core.data lookups still find the section. Sections
+    that can reference other ini files are always parsed right away, so the
+    referenced files are still queued.
+
+    Note lines are only validated when parsed, so cross reference checks
+    (-m|--match rule arguments) for sections that were never accessed are only
+    added to the match queue when IniFile.parse_lazy() is called, as
+    core.validate_match_queue() does.
+    """
+    __slots__ = ('_parsed',
+                 '_registered', # sort key added to the core.data handlers
+                )
+
+    def __init__(self, section, lines=None, index=None, parent=None, span=None):
+        self._parsed = False
+        self._registered = False
+        IniSection.__init__(self, section, lines, index, parent, parse=False,
+                            span=span)
+        if not self.group:
+            return
+        try:
+            self.rules = parser.get_rules(self.group, self.section)
+        except KeyError:
+            return # warned about when parsed
+        if self.rules.references:
+            # parsed with the rest of the file, no flush_checks() needed
+            self._parsed = True
+            IniSection.parse(self)
+            return
+        sortkey = self.rules.sortkey
+        if not sortkey or not self.file.flags&FLAG_FLDATA:
+            return
+        for line in self._getlines(1):
+            if line.lstrip()[:len(sortkey)].lower() != sortkey:
+                continue
+            split = splitline(line)
+            if split and split[0].lower() == sortkey:
+                self._add_unique_key(split[1])
+                return
+
+
+    def parse(self):
+        """LazyIniSection.parse()
+        Parses the data for the section if it hasnt been already. Normally
+        automatically called when a key is first accessed. Any numeric checks
+        batched while parsing are done right away.
+        """
+        if self._parsed:
+            return
+        self._parsed = True
+        IniSection.parse(self)
+        parser.flush_checks()
+
+
+    def _add_unique_key(self, value=None):
+        if self._registered:
+            return
+        self._registered = True
+        IniSection._add_unique_key(self, value)
+
+
+    def __reduce_ex__(self, protocol):
+        # dont parse the section just to pickle or unpickle it
+        return (copy_reg.__newobj__, (self.__class__,),
+                (self.__getstate__(), dict(dict.iteritems(self))))
+
+
+    def __setstate__(self, state):
+        state, items = state
+        IniSection.__setstate__(self, state)
+        dict.update(self, items)
+
+
+    def __getitem__(self, key):
+        self.parse()
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        self.parse()
+        IniSection.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self.parse()
+        IniSection.__delitem__(self, key)
+
+    def __contains__(self, key):
+        self.parse()
+        return dict.__contains__(self, key)
+
+    def __iter__(self):
+        self.parse()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self.parse()
+        return dict.__len__(self)
+
+    def get(self, key, default=None, dtype=None):
+        self.parse()
+        return IniSection.get(self, key, default, dtype)
+
+    def set(self, key, value):
+        self.parse()
+        IniSection.set(self, key, value)
+
+    def has_key(self, key):
+        self.parse()
+        return dict.has_key(self, key)
+
+    def keys(self):
+        self.parse()
+        return dict.keys(self)
+
+    def values(self):
+        self.parse()
+        return dict.values(self)
+
+    def items(self):
+        self.parse()
+        return dict.items(self)
+
+    def iterkeys(self):
+        self.parse()
+        return dict.iterkeys(self)
+
+    def itervalues(self):
+        self.parse()
+        return dict.itervalues(self)
+
+    def iteritems(self):
+        self.parse()
+        return dict.iteritems(self)
+
+    def pop(self, key, *args):
+        self.parse()
+        return IniSection.pop(self, key, *args)
+
+    def popitem(self):
+        self.parse()
+        return IniSection.popitem(self)
+
+    def setdefault(self, key, default=None):
+        self.parse()
+        return IniSection.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        self.parse()
+        IniSection.update(self, *args, **kwargs)
+
+    def clear(self):
+        self.parse()
+        IniSection.clear(self)
+
+
+
+#==============================================================================
+#
+#==============================================================================
+
+class _IniStream(object):
+    """_IniStream(filename, directory=None, group=None, flags=0)
+    Internal class. Stands in for the parent IniFile of sections generated by
+    iter_sections(), without holding any of the sections or lines.
+    """
+    changed = False
+    streamed = True
+    _data = None
+
+    def __init__(self, filename, directory=None, group=None, flags=0):
+        if directory:
+            self.fullpath = join(directory, filename)
+        else:
+            self.fullpath = filename
+        if group:
+            group = group.lower()
+        self.group = group
+        self.path = filename
+        self.flags = flags
+        self.keymap = {}
+
+    def __repr__(self):
+        return "%s (streamed)" % self.path
+
+
+def iter_sections(path, group=None, sections=None, directory=None, flags=0):
+    r"""iter_sections(path, group=None, sections=None, directory=None, flags=0)
+    Reads a ini file one line at a time, yielding a IniSection object as each
+    [Section] is read. Unlike IniFile only the current section is kept in
+    memory. If sections is a list of section names, only those sections are
+    yielded, the lines of any others are skipped without being parsed.
+    group and flags are the same as IniFile, but FLAG_FLDATA and FLAG_LAZY are
+    ignored: streamed sections are never added to core.data. Lines are still
+    validated if a group is given, but -m cross references arent checked and
+    referenced ini files arent queued.
+
+    # find the bases in a huge system file without loading it
+    for obj in iter_sections(r'universe\systems\li01\li01.ini', 'systems',
+                             ['object'], directory=data_path):
+        if obj.get('base'):
+            print obj['nickname']
+    """
+    stream = _IniStream(path, directory, group, flags & (FLAG_LOG + FLAG_STAT))
+    if sections is not None:
+        sections = set([name.lower() for name in sections])
+    if not exists(stream.fullpath):
+        raise FileReadError("Missing File", path)
+    if stream.flags&FLAG_LOG:
+        log.info('Streaming File (%s): %s' % (stream.group, path))
+    if stream.flags&FLAG_STAT:
+        stats_inc(STATS_FILES)
+
+    fih = open(stream.fullpath, 'rb')
+    if bini.is_bini(fih.read(4)):
+        fih.seek(0)
+        data = fih.read()
+        fih.close()
+        fih = bini.iter_lines(data)
+    else:
+        fih.close()
+        fih = open(stream.fullpath, 'rU')
+    try:
+
+        section = None
+        lines = None # lines of the current section, None if skipped
+        index = 0
+        for i, line in enumerate(fih):
+            line = line.rstrip()
+            if stream.flags&FLAG_STAT:
+                stats_inc(STATS_LINES)
+
+            name = section_name(line) # check for new [section]
+            if name is None:
+                if lines is not None:
+                    lines.append(line)
+                continue
+
+            if lines is not None:
+                yield IniSection(section, lines, index, stream)
+            section = name.lower()
+            index = 1 + i
+            lines = None
+            if sections is None or section in sections:
+                lines = [line]
+
+        if lines is not None: # last section in file
+            yield IniSection(section, lines, index, stream)
+    except bini.BiniError as msg:
+        raise FileReadError("Bad BINI File (%s)" % msg, stream.fullpath)
+    finally:
+        fih.close()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+# =============================================================================
+#
+#    Copyright (C) 2016  Fenris_Wolf, YSPStudios
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =============================================================================
+
+"""
+    benchmark_tokenizer.py - Compares the ini line tokenizing speed of the old
+    per-line regexes with freelancer.core.tokenizer
+
+    Generates a large system-like ini and reports lines/sec for both methods:
+    the section check done by IniFile.read(), the blank check and key/value
+    split done by IniSection.parse(), and the comma split done by
+    LineRule.check().
+
+    Usage: python benchmark_tokenizer.py [sections]
+"""
+
+import os
+from os.path import join
+import sys
+import time
+
+# Assume we're running from PyFL\scripts directory
+os.chdir('..')
+sys.path[:] = [join(os.getcwd(), 'lib')] + sys.path
+
+from freelancer.core.regex import (SECTION_RE, LINE_COMMENT_RE, LINE_SPLIT_RE,
+                                   COMMA_SPLIT_RE)
+from freelancer.core.tokenizer import (section_name, is_blank, split_line,
+                                       split_args)
+
+
+def generate(sections):
+    """Returns a list of lines for a large generated system ini"""
+    lines = ['; generated benchmark system', '']
+    for index in range(sections):
+        lines.extend([
+            '[Object]',
+            'nickname = Li01_object_%s' % index,
+            'ids_name = %s' % (196000 + index),
+            'pos = %s, 0, -%s ; position' % (index * 10, index * 5),
+            'rotate = 0, 90, 0',
+            'archetype = largestation1',
+            '; commented_out = 1',
+            'reputation = li_p_grp',
+            'behavior = NOTHING',
+            '',
+            '[zone]',
+            'nickname = Zone_Li01_%s' % index,
+            'pos = %s.5, 0, %s.25' % (index, index),
+            'shape = SPHERE',
+            'size = 2000',
+            'faction_weight = li_p_grp, 10',
+            'encounter = area_defend, 5, 0.400000',
+            '',
+        ])
+    return lines
+
+
+def regex_pass(lines):
+    """The old regex based tokenizing"""
+    for line in lines:
+        if SECTION_RE.match(line):
+            continue
+        if not LINE_COMMENT_RE.sub('', line):
+            continue
+        match = LINE_SPLIT_RE.match(line)
+        if match:
+            COMMA_SPLIT_RE.split(match.group(2))
+
+
+def tokenizer_pass(lines):
+    """The freelancer.core.tokenizer based tokenizing"""
+    for line in lines:
+        if section_name(line) is not None:
+            continue
+        if is_blank(line):
+            continue
+        split = split_line(line)
+        if split:
+            split_args(split[1])
+
+
+def run(name, func, lines, repeat=3):
+    """Runs func, reporting the best lines/sec"""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func(lines)
+        taken = time.time() - start
+        if best is None or taken < best:
+            best = taken
+    print "%-10s %8.3f seconds  %10d lines/sec" % (name, best, len(lines) / best)
+    return best
+
+
+def main():
+    sections = 20000
+    if len(sys.argv) > 1:
+        sections = int(sys.argv[1])
+    lines = generate(sections)
+    print "%s lines" % len(lines)
+    before = run('regex', regex_pass, lines)
+    after = run('tokenizer', tokenizer_pass, lines)
+    print "speedup: %.2fx" % (before / after)
+
+
+if __name__ == '__main__':
+    main()